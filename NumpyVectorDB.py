@@ -0,0 +1,363 @@
+import hashlib
+import json
+import os
+import re
+import struct
+import threading
+
+import numpy as np
+
+from conf import local_vector_db_path
+from distance import normalize_rows, top_k
+from doc_registry import chunks_removed
+from utils.fingerprint import chunk_fingerprint
+
+# 向量文件使用固定 128 字节的 .npy 文件头，追加数据时只需原地改写文件头中的 shape
+_NPY_HEADER_SIZE = 128
+
+
+def _write_npy_header(f, rows, dim):
+    header = "{'descr': '<f4', 'fortran_order': False, 'shape': (%d, %d), }" % (rows, dim)
+    header = header.ljust(_NPY_HEADER_SIZE - 10 - 1) + '\n'
+    f.seek(0)
+    f.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1'))
+
+
+def _append_npy(path, rows):
+    '''把若干行追加到 .npy 文件末尾，不重写已有数据'''
+    rows = np.ascontiguousarray(rows, dtype='<f4')
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            np.lib.format.read_magic(f)
+            (n, dim), _, _ = np.lib.format.read_array_header_1_0(f)
+        mode = 'r+b'
+    else:
+        n, dim = 0, rows.shape[1]
+        mode = 'wb'
+    with open(path, mode) as f:
+        f.seek(_NPY_HEADER_SIZE + n * dim * 4)
+        f.write(rows.tobytes())
+        _write_npy_header(f, n + len(rows), dim)
+
+
+class _Segment:
+    """
+    一个文档的全部片段：向量存于 .npy 文件，原文和 metadata 存于 .jsonl 边车文件
+
+    向量整体读入内存（已归一化，预留增长空间），检索时直接做矩阵向量乘，不再每次切片内存映射。
+    """
+    def __init__(self, base_path):
+        self.npy_path = base_path + '.npy'
+        self.meta_path = base_path + '.jsonl'
+        self.ids = []
+        self.documents = []
+        self.metadatas = []
+        self.id_set = set()
+        # 前 len(ids) 行有效，其余为追加预留的空间
+        self._matrix = None
+        if os.path.exists(self.meta_path):
+            self._load()
+
+    @property
+    def vectors(self):
+        return None if self._matrix is None else self._matrix[:len(self.ids)]
+
+    def _load(self):
+        complete = True
+        with open(self.meta_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    # 写了一半的行
+                    complete = False
+                    break
+                self.ids.append(row['id'])
+                self.documents.append(row['document'])
+                self.metadatas.append(row['metadata'])
+        vectors = np.load(self.npy_path, mmap_mode='r') if os.path.exists(self.npy_path) else None
+        n = min(len(self.ids), 0 if vectors is None else len(vectors))
+        if vectors is not None and n:
+            self._matrix = np.array(vectors[:n])
+        aligned = complete and n == len(self.ids) and (vectors is None or n == len(vectors))
+        dim = None if vectors is None else vectors.shape[1]
+        del vectors
+        del self.ids[n:], self.documents[n:], self.metadatas[n:]
+        if not aligned:
+            self._truncate(n, dim)
+        self.id_set = set(self.ids)
+
+    def _truncate(self, n, dim):
+        '''
+        写入中途退出时两个文件的行数可能不一致，把两个文件都截到前 n 行
+
+        只在内存中截断不够：之后追加的向量会接在多出的行后面，与原文错位
+        '''
+        tmp_path = self.meta_path + '.tmp'
+        with open(self.meta_path, encoding='utf-8') as src, open(tmp_path, 'w', encoding='utf-8') as dst:
+            for _, line in zip(range(n), src):
+                dst.write(line)
+        os.replace(tmp_path, self.meta_path)
+        if dim is not None:
+            with open(self.npy_path, 'r+b') as f:
+                _write_npy_header(f, n, dim)
+                f.truncate(_NPY_HEADER_SIZE + n * dim * 4)
+
+    def _reserve(self, rows, dim):
+        '''保证内存矩阵至少有 rows 行，按倍数扩容，逐批追加时不必每次复制全部向量'''
+        capacity = 0 if self._matrix is None else len(self._matrix)
+        if capacity >= rows:
+            return
+        matrix = np.empty((max(rows, capacity * 2), dim), dtype=np.float32)
+        if self._matrix is not None:
+            matrix[:len(self.ids)] = self._matrix[:len(self.ids)]
+        self._matrix = matrix
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, ids, documents, metadatas, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        _append_npy(self.npy_path, vectors)
+        with open(self.meta_path, 'a', encoding='utf-8') as f:
+            for row in zip(ids, documents, metadatas):
+                f.write(json.dumps(dict(zip(('id', 'document', 'metadata'), row)), ensure_ascii=False) + '\n')
+        n = len(self.ids)
+        self._reserve(n + len(vectors), vectors.shape[1])
+        self._matrix[n:n + len(vectors)] = vectors
+        self.ids.extend(ids)
+        self.documents.extend(documents)
+        self.metadatas.extend(metadatas)
+        self.id_set.update(ids)
+
+    def keep(self, rows):
+        '''只保留指定的行，重写两个文件'''
+        vectors = np.array(self.vectors[rows]) if self.vectors is not None else None
+        ids = [self.ids[i] for i in rows]
+        documents = [self.documents[i] for i in rows]
+        metadatas = [self.metadatas[i] for i in rows]
+        self.remove()
+        if ids:
+            self.append(ids, documents, metadatas, vectors)
+
+    def remove(self):
+        self._matrix = None
+        for path in (self.npy_path, self.meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.ids, self.documents, self.metadatas, self.id_set = [], [], [], set()
+
+    def search(self, query, k):
+        '''返回 (相似度, 行号)，按相似度从高到低排列'''
+        if self.vectors is None or not len(self.ids):
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        return top_k(self.vectors @ query, k)
+
+
+def _segment_name(doc_id):
+    if doc_id is None:
+        return '_default'
+    if re.fullmatch(r'[\w-]{1,64}', doc_id):
+        return doc_id
+    return hashlib.sha256(doc_id.encode('utf-8')).hexdigest()
+
+
+class NumpyVectorStore:
+    """进程内的向量库，每个文档一个分段，向量已归一化，检索只需一次矩阵向量乘"""
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.lock = threading.RLock()
+        self.segments = {}
+        self.doc_ids = {}
+        for name in os.listdir(path):
+            if name.endswith('.jsonl'):
+                segment = _Segment(os.path.join(path, name[:-len('.jsonl')]))
+                if len(segment):
+                    doc_id = segment.metadatas[0].get('doc_id')
+                    self.segments[_segment_name(doc_id)] = segment
+                    self.doc_ids[_segment_name(doc_id)] = doc_id
+
+    def segment(self, doc_id, create=False):
+        name = _segment_name(doc_id)
+        with self.lock:
+            if name not in self.segments and create:
+                self.segments[name] = _Segment(os.path.join(self.path, name))
+                self.doc_ids[name] = doc_id
+            return self.segments.get(name)
+
+    def drop(self, doc_id):
+        with self.lock:
+            name = _segment_name(doc_id)
+            segment = self.segments.pop(name, None)
+            self.doc_ids.pop(name, None)
+            if segment is not None:
+                segment.remove()
+
+
+# 同一目录的向量库在进程内只加载一次
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_numpy_store(path):
+    path = os.path.abspath(path)
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = NumpyVectorStore(path)
+        return _stores[path]
+
+
+class NumpyVectorDBConnector:
+    """
+    嵌入式的向量库，接口与 MyVectorDBConnector 一致，不需要单独运行 chroma 服务
+
+    向量以 float32 归一化后保存，余弦相似度即内积，distances 为余弦距离 (1 - 相似度)
+    """
+    def __init__(self, collection_name, embedding_fn, doc_id=None, path=local_vector_db_path):
+        """
+        :param collection_name: collection 名称，对应 path 下的一个子目录
+        :param embedding_fn: 计算向量的函数
+        :param doc_id: 文档指纹，指定后所有读写都限定在该文档的片段内
+        :param path: 向量库的存放目录
+        """
+        self.store = get_numpy_store(os.path.join(path, collection_name))
+        self.collection_name = collection_name
+        self.embedding_fn = embedding_fn
+        self.doc_id = doc_id
+
+    def count_documents(self):
+        """当前文档（未指定文档时为整个 collection）的片段数"""
+        with self.store.lock:
+            if self.doc_id is None:
+                return sum(len(s) for s in self.store.segments.values())
+            segment = self.store.segment(self.doc_id)
+            return len(segment) if segment is not None else 0
+
+    def add_documents(self, documents, metadatas=None):
+        """
+        向向量库中添加文档与向量，已存在的片段直接跳过
+
+        :return: 新写入的片段数
+        """
+        if metadatas is None:
+            metadatas = [{} for _ in documents]
+        with self.store.lock:
+            segment = self.store.segment(self.doc_id, create=True)
+            chunks = {}
+            for doc, meta in zip(documents, metadatas):
+                chunk_id = chunk_fingerprint(self.doc_id, doc)
+                if chunk_id not in chunks and chunk_id not in segment.id_set:
+                    chunks[chunk_id] = (doc, dict(meta, doc_id=self.doc_id) if self.doc_id else dict(meta))
+            if not chunks:
+                return 0
+            new_docs = [doc for doc, _ in chunks.values()]
+            vectors = normalize_rows(self.embedding_fn(new_docs))
+            segment.append(list(chunks), new_docs, [meta for _, meta in chunks.values()], vectors)
+            return len(chunks)
+
+    def search(self, query, top_k=5, embedding=None):
+        """
+        检索向量库，返回与 chroma 相同格式的结果
+
+        :param embedding: 已算好的查询向量，提供时不再调用 embedding_fn
+        """
+        if embedding is None:
+            embedding = self.embedding_fn([query])[0]
+        return self.search_by_embedding(embedding, top_k)
+
+    def search_by_embedding(self, embedding, top_k=5):
+        """用已算好的查询向量检索"""
+        query = normalize_rows([embedding])[0]
+        with self.store.lock:
+            if self.doc_id is not None:
+                segment = self.store.segment(self.doc_id)
+                segments = [segment] if segment is not None else []
+            else:
+                segments = list(self.store.segments.values())
+            # 每个分段各取 top_k，再合并
+            hits = []
+            for segment in segments:
+                scores, rows = segment.search(query, top_k)
+                hits.extend((float(s), segment, int(r)) for s, r in zip(scores, rows))
+        hits.sort(key=lambda x: -x[0])
+        hits = hits[:top_k]
+        return {
+            'ids': [[seg.ids[r] for _, seg, r in hits]],
+            'documents': [[seg.documents[r] for _, seg, r in hits]],
+            'metadatas': [[seg.metadatas[r] for _, seg, r in hits]],
+            'distances': [[1 - s for s, _, _ in hits]],
+        }
+
+    def get_documents(self):
+        """当前文档（未指定文档时为整个 collection）的全部片段，返回含 ids、documents、metadatas 的字典"""
+        with self.store.lock:
+            if self.doc_id is not None:
+                segment = self.store.segment(self.doc_id)
+                segments = [segment] if segment is not None else []
+            else:
+                segments = list(self.store.segments.values())
+            return {'ids': [i for s in segments for i in s.ids],
+                    'documents': [d for s in segments for d in s.documents],
+                    'metadatas': [m for s in segments for m in s.metadatas]}
+
+    def list_documents(self):
+        """列出向量库中的文档指纹及各自的片段数"""
+        with self.store.lock:
+            return {self.store.doc_ids[name]: len(s) for name, s in self.store.segments.items()}
+
+    def drop_document(self, doc_id=None):
+        """删除一个文档的全部片段"""
+        doc_id = doc_id or self.doc_id
+        if doc_id is None:
+            raise ValueError("drop_document 需要指定 doc_id")
+        self.store.drop(doc_id)
+        chunks_removed("numpy", self.collection_name, doc_id)
+
+    def compact_document(self, documents, doc_id=None):
+        """
+        只保留与 documents 内容一致的片段，删除该文档旧版本遗留的片段
+
+        :return: 删除的片段数
+        """
+        doc_id = doc_id or self.doc_id
+        if doc_id is None:
+            raise ValueError("compact_document 需要指定 doc_id")
+        keep = {chunk_fingerprint(doc_id, doc) for doc in documents}
+        with self.store.lock:
+            segment = self.store.segment(doc_id)
+            if segment is None:
+                return 0
+            rows = [i for i, chunk_id in enumerate(segment.ids) if chunk_id in keep]
+            stale = [chunk_id for chunk_id in segment.ids if chunk_id not in keep]
+            if stale:
+                segment.keep(rows)
+        if stale:
+            chunks_removed("numpy", self.collection_name, doc_id, stale)
+        return len(stale)
+
+
+if "__main__" == __name__:
+    import tempfile
+    import time
+
+    # 10 万个 256 维片段的检索延迟
+    rng = np.random.default_rng(0)
+    n, dim = 100000, 256
+    corpus = rng.standard_normal((n, dim)).astype(np.float32)
+    lookup = {}
+    def embedding_fn(texts):
+        return np.stack([lookup[t] if t in lookup else corpus[int(t)] for t in texts])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = NumpyVectorDBConnector("bench", embedding_fn, doc_id="bench", path=tmp)
+        start = time.perf_counter()
+        for i in range(0, n, 10000):
+            db.add_documents([str(j) for j in range(i, i + 10000)])
+        print(f"写入 {db.count_documents()} 条耗时 {(time.perf_counter() - start) * 1000:.1f} ms")
+        for i in range(100):
+            lookup[f"q{i}"] = rng.standard_normal(dim).astype(np.float32)
+        start = time.perf_counter()
+        for i in range(100):
+            result = db.search(f"q{i}", 5)
+        print(f"平均检索耗时 {(time.perf_counter() - start) * 10:.3f} ms")
@@ -1,20 +1,228 @@
-from mybase import build_prompt,prompt_template
+import asyncio
+import logging
+
+from openai import OpenAIError
+
+from mybase import build_prompt,build_rag_prompt
+from utils.fusion import reciprocal_rank_fusion
+
+logger = logging.getLogger(__name__)
+
+def _first(results):
+    return results[0] if results else None
 
 class RAG_Bot:
     """ 基于向量检索的 RAG """
-    def __init__(self, vector_db, llm_api, n_results=2):
+    def __init__(self, vector_db, llm_api, n_results=2, llm_stream_api=None, answer_cache=None,
+                 reranker=None, n_candidates=8, model="gpt-3.5-turbo", context_tokens=None):
+        """
+        :param llm_api: 一次性返回完整回答的 LLM 接口
+        :param llm_stream_api: 逐段 yield 回答的流式 LLM 接口，stream_chat 使用
+        :param answer_cache: 问答缓存（answer_cache.AnswerCache），命中时不检索也不调用 LLM
+        :param reranker: 重排器（reranker.Reranker），提供时先取 n_candidates 个候选再重排出 n_results 个
+        :param model: llm_api 使用的模型，用于确定上下文的 token 预算
+        :param context_tokens: 上下文的 token 预算，None 表示按 model 取 conf 中的预算
+        """
         self.vector_db = vector_db
         self.llm_api = llm_api
         self.n_results = n_results
+        self.llm_stream_api = llm_stream_api
+        self.answer_cache = answer_cache
+        self.reranker = reranker
+        self.n_candidates = max(n_candidates, n_results)
+        self.model = model
+        self.context_tokens = context_tokens
+
+    def _retrieve(self, user_query):
+        '''
+        查答案缓存并检索，问题向量最多计算一次
+
+        依次为：答案缓存精确匹配、关键词精确命中（HybridRetriever）、计算问题向量后做语义匹配、向量检索，
+        前面命中时不再调用 Embedding 接口。
+        :return: (缓存的回答, 检索结果, 问题向量)，命中缓存时检索结果为 None，未计算向量时向量为 None
+        '''
+        doc_id = getattr(self.vector_db, 'doc_id', None)
+        if self.answer_cache is not None:
+            cached = self.answer_cache.get(doc_id, user_query)
+            if cached is not None:
+                return cached, None, None
+        n = self.n_results if self.reranker is None else self.n_candidates
+        search_kwargs = {}
+        if hasattr(self.vector_db, 'keyword_search'):
+            exact, search_kwargs['keyword_results'] = self.vector_db.keyword_search(user_query, n)
+            if exact is not None:
+                if self.answer_cache is not None:
+                    self.answer_cache.match(doc_id, None)
+                return None, exact, None
+        embedding = self.vector_db.embedding_fn([user_query])[0]
+        if self.answer_cache is not None:
+            cached = self.answer_cache.match(doc_id, embedding)
+            if cached is not None:
+                return cached, None, embedding
+        return None, self.vector_db.search(user_query, n, embedding=embedding, **search_kwargs), embedding
+
+    def _build_prompt(self, user_query, search_results):
+        # 1. 有重排器时从候选中重排出 n_results 个
+        if self.reranker is not None:
+            search_results = self.reranker.rerank(user_query, search_results, self.n_results)
 
-    def chat(self, user_query):
-        # 1. 检索
-        search_results = self.vector_db.search(user_query, self.n_results)
+        # 2. 构建 Prompt，整理上下文；同一个 bot 可能被多个会话共用，用量随结果返回并写入日志，不记在实例上
+        prompt, usage = build_rag_prompt(
+            user_query, search_results['documents'][0], _first(search_results.get('metadatas')),
+            self.model, self.context_tokens)
+        logger.info("doc=%s prompt 用量: %s", getattr(self.vector_db, 'doc_id', None), usage)
+        return prompt, usage
 
-        # 2. 构建 Prompt
-        prompt = build_prompt(
-            prompt_template, context=search_results['documents'][0], query=user_query)
+    def _remember(self, user_query, response, embedding):
+        if self.answer_cache is not None:
+            self.answer_cache.put(getattr(self.vector_db, 'doc_id', None), user_query, response, embedding)
+
+    def chat(self, user_query, return_usage=False):
+        """
+        :param return_usage: 为 True 时返回 (回答, prompt 用量)，答案缓存命中时用量为 None
+        """
+        cached, search_results, embedding = self._retrieve(user_query)
+        if cached is not None:
+            return (cached, None) if return_usage else cached
+        prompt, usage = self._build_prompt(user_query, search_results)
 
         # 3. 调用 LLM
         response = self.llm_api(prompt)
-        return response
\ No newline at end of file
+        self._remember(user_query, response, embedding)
+        return (response, usage) if return_usage else response
+
+    def stream_chat(self, user_query):
+        """流式回答，逐段 yield 生成的文本，prompt 用量见日志"""
+        cached, search_results, embedding = self._retrieve(user_query)
+        if cached is not None:
+            yield cached
+            return
+        prompt, _ = self._build_prompt(user_query, search_results)
+
+        # 3. 调用 LLM，没有流式接口时一次性返回
+        if self.llm_stream_api is None:
+            response = self.llm_api(prompt)
+            yield response
+        else:
+            parts = []
+            for part in self.llm_stream_api(prompt):
+                parts.append(part)
+                yield part
+            response = ''.join(parts)
+        # 只缓存完整生成的回答，中途断开的不缓存
+        self._remember(user_query, response, embedding)
+
+
+rewrite_template = """
+    请把下面的用户问题改写成 {n} 个意思相同、措辞不同的检索语句，用于从文档中查找相关内容。
+    每行输出一个，不要编号，不要输出其他内容。
+
+    用户问题：
+    {query}
+    """
+
+# 各阶段的默认超时（秒）
+default_timeouts = {"embed": 10, "search": 5, "rewrite": 5, "generate": 60}
+
+
+class AsyncRAGBot:
+    """
+    基于 asyncio 的 RAG，一个事件循环里可以并发处理多个问题
+
+    原问题的检索与问题改写同时进行，改写得到的查询批量计算向量、并行检索后用 RRF 合并。
+    每个阶段有各自的超时，改写超时或失败时只用原问题的检索结果。
+    """
+    def __init__(self, vector_db, llm_api, embedding_api, n_results=2, n_rewrites=0,
+                 llm_stream_api=None, timeouts=None, model="gpt-3.5-turbo", context_tokens=None):
+        """
+        :param vector_db: 向量库或 HybridRetriever，search 需支持传入算好的 embedding
+        :param llm_api: 异步 LLM 接口，如 mybase.aget_completion
+        :param embedding_api: 异步 Embedding 接口，如 mybase.aget_embeddings
+        :param n_rewrites: 让 LLM 改写出的额外查询数，0 表示不改写
+        :param llm_stream_api: 异步流式 LLM 接口，如 mybase.aget_completion_stream
+        :param timeouts: 各阶段超时（秒），键为 embed / search / rewrite / generate，None 表示不限
+        :param model: llm_api 使用的模型，用于确定上下文的 token 预算
+        :param context_tokens: 上下文的 token 预算，None 表示按 model 取 conf 中的预算
+        """
+        self.vector_db = vector_db
+        self.llm_api = llm_api
+        self.embedding_api = embedding_api
+        self.n_results = n_results
+        self.n_rewrites = n_rewrites
+        self.llm_stream_api = llm_stream_api
+        self.timeouts = dict(default_timeouts, **(timeouts or {}))
+        self.model = model
+        self.context_tokens = context_tokens
+
+    async def _stage(self, name, aw):
+        return await asyncio.wait_for(aw, self.timeouts.get(name))
+
+    async def _search(self, queries):
+        '''批量计算查询向量，再在线程池中并行检索，返回每个查询的检索结果'''
+        embeddings = await self._stage('embed', self.embedding_api(queries))
+        searches = [asyncio.to_thread(self.vector_db.search, q, self.n_results, embedding=e)
+                    for q, e in zip(queries, embeddings)]
+        return await self._stage('search', asyncio.gather(*searches))
+
+    async def rewrite(self, user_query):
+        '''让 LLM 把问题改写成若干检索语句'''
+        prompt = build_prompt(rewrite_template, n=self.n_rewrites, query=user_query)
+        response = await self._stage('rewrite', self.llm_api(prompt))
+        queries = []
+        for line in response.splitlines():
+            line = line.strip(' -*•\t')
+            if line and line != user_query and line not in queries:
+                queries.append(line)
+        return queries[:self.n_rewrites]
+
+    async def retrieve(self, user_query):
+        '''检索原问题的同时改写问题，返回与 chroma 相同格式的合并结果'''
+        original = asyncio.ensure_future(self._search([user_query]))
+        try:
+            rewrites = []
+            if self.n_rewrites:
+                try:
+                    rewrites = await self.rewrite(user_query)
+                except (asyncio.TimeoutError, OpenAIError):
+                    rewrites = []
+            results = list(await original)
+            if rewrites:
+                results.extend(await self._search(rewrites))
+        finally:
+            # 出错或被取消时不留下悬空的检索任务
+            original.cancel()
+        if len(results) == 1:
+            return results[0]
+        return reciprocal_rank_fusion(results, top_n=self.n_results)
+
+    async def _build_prompt(self, user_query):
+        # 并发处理多个问题，用量随结果返回而不记在实例上
+        search_results = await self.retrieve(user_query)
+        return build_rag_prompt(
+            user_query, search_results['documents'][0], _first(search_results.get('metadatas')),
+            self.model, self.context_tokens)
+
+    async def chat(self, user_query, return_usage=False):
+        """
+        :param return_usage: 为 True 时返回 (回答, prompt 用量)
+        """
+        prompt, usage = await self._build_prompt(user_query)
+        response = await self._stage('generate', self.llm_api(prompt))
+        return (response, usage) if return_usage else response
+
+    async def stream_chat(self, user_query):
+        """流式回答，generate 超时作用于相邻两段输出之间的等待"""
+        prompt, _ = await self._build_prompt(user_query)
+        if self.llm_stream_api is None:
+            yield await self._stage('generate', self.llm_api(prompt))
+            return
+        stream = self.llm_stream_api(prompt)
+        try:
+            while True:
+                try:
+                    chunk = await self._stage('generate', stream.__anext__())
+                except StopAsyncIteration:
+                    break
+                yield chunk
+        finally:
+            await stream.aclose()
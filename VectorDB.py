@@ -1,48 +1,215 @@
+import threading
+import time
+
 import chromadb
 from chromadb.config import Settings
 
+from conf import chroma_host, chroma_port, local_vector_db_path, vector_backend
+from doc_registry import chunks_removed
+from resources import get_resource, release_resource
+from utils.fingerprint import chunk_fingerprint
+
+# 进程内共享的客户端和 collection，streamlit 每次重跑脚本、每个会话都复用同一个连接
+_clients = set()
+_collections = {}
+_registry_lock = threading.Lock()
+
+def get_chroma_client(host=chroma_host, port=chroma_port):
+    """获取共享的 chroma 客户端，同一地址只创建一次，底层 HTTP 连接保持复用"""
+    with _registry_lock:
+        _clients.add((host, port))
+    return get_resource(f"chroma:{host}:{port}", lambda: chromadb.HttpClient(host=host, port=port))
+
+def get_collection(name, host=chroma_host, port=chroma_port):
+    """获取共享的 collection，只在第一次使用时向服务端查询或创建"""
+    key = (host, port, name)
+    collection = _collections.get(key)
+    if collection is None:
+        client = get_chroma_client(host, port)
+        with _registry_lock:
+            collection = _collections.get(key)
+            if collection is None:
+                collection = _collections[key] = client.get_or_create_collection(name=name)
+    return collection
+
+def health_check(host=chroma_host, port=chroma_port):
+    """检查 chroma 服务是否可用，返回心跳耗时（毫秒），不可用时返回 None"""
+    try:
+        start = time.perf_counter()
+        get_chroma_client(host, port).heartbeat()
+        return (time.perf_counter() - start) * 1000
+    except Exception:
+        # 连接失效时丢弃缓存，下次重新连接
+        reset_clients(host, port)
+        return None
+
+def reset_clients(host=None, port=None):
+    """清空共享的客户端和 collection（例如 chroma 服务重启后），不指定地址时全部清空"""
+    with _registry_lock:
+        for key in list(_clients):
+            if host is None or key == (host, port):
+                _clients.discard(key)
+                release_resource(f"chroma:{key[0]}:{key[1]}")
+        for key in list(_collections):
+            if host is None or key[:2] == (host, port):
+                del _collections[key]
+
+def _to_list(embeddings):
+    '''chroma 接收 list 形式的向量，embedding_fn 可能返回 numpy 矩阵'''
+    return embeddings.tolist() if hasattr(embeddings, 'tolist') else embeddings
+
 class MyVectorDBConnector:
-    def __init__(self, collection_name, embedding_fn) -> None:
+    def __init__(self, collection_name, embedding_fn, doc_id=None, host=chroma_host, port=chroma_port) -> None:
+        """
+        :param collection_name: collection 名称
+        :param embedding_fn: 计算向量的函数
+        :param doc_id: 文档指纹，指定后所有读写都限定在该文档的片段内
+        :param host: chroma 服务地址
+        :param port: chroma 服务端口
+        """
         # chroma_client = chromadb.Client(Settings(
         #     allow_reset=True,
         # ))
         # # 不需要每次都reset
         # chroma_client.reset()
 
-        chroma_client = chromadb.HttpClient(host='localhost', port=8000)
-        
-        self.collection = chroma_client.get_or_create_collection(
-            name=collection_name)
+        # 复用进程内共享的连接和 collection，构造连接器不再产生网络请求
+        self.collection = get_collection(collection_name, host, port)
+        self.collection_name = collection_name
         self.embedding_fn = embedding_fn
-        self.documents = []
+        self.doc_id = doc_id
+
+    def _where(self, doc_id=None):
+        doc_id = doc_id or self.doc_id
+        return {"doc_id": doc_id} if doc_id else None
 
     def count_documents(self):
-        return len(self.documents)
-
-    def add_documents(self, documents):
-        """向 collection 中添加文档与向量"""
-        self.collection.add(
-            embeddings=self.embedding_fn(documents),  # 每个文档的向量
-            documents=documents,  # 文档的原文
-            ids=[f"id{i}" for i in range(len(documents))]  # 每个文档的 id
+        """当前文档（未指定文档时为整个 collection）的片段数"""
+        if self.doc_id is None:
+            return self.collection.count()
+        return len(self.collection.get(where=self._where(), include=[])['ids'])
+
+    def add_documents(self, documents, metadatas=None):
+        """
+        向 collection 中添加文档与向量
+
+        片段 id 由文档指纹和内容哈希得到，已存在的片段直接跳过，不会重复计算向量
+        :return: 新写入的片段数
+        """
+        if metadatas is None:
+            metadatas = [{} for _ in documents]
+        # 按 id 去重，同一内容只保留一份
+        chunks = {}
+        for doc, meta in zip(documents, metadatas):
+            chunk_id = chunk_fingerprint(self.doc_id, doc)
+            if chunk_id not in chunks:
+                chunks[chunk_id] = (doc, dict(meta, doc_id=self.doc_id) if self.doc_id else meta)
+        if not chunks:
+            return 0
+        existing = set(self.collection.get(ids=list(chunks), include=[])['ids'])
+        new_ids = [i for i in chunks if i not in existing]
+        if not new_ids:
+            return 0
+        new_docs = [chunks[i][0] for i in new_ids]
+        new_metas = [chunks[i][1] for i in new_ids]
+        self.collection.upsert(
+            embeddings=_to_list(self.embedding_fn(new_docs)),  # 每个文档的向量
+            documents=new_docs,  # 文档的原文
+            metadatas=[meta or None for meta in new_metas],  # chroma 不接受空的 metadata，逐条换成 None
+            ids=new_ids  # 每个文档的 id
         )
-        # 更新 self.documents 列表
-        self.documents.extend(documents)
-        # 调试信息
-        # print(f"添加的文档数: {len(documents)}")
-        # print(f"当前文档总数: {len(self.documents)}")
-
-    def search(self, query, top_k=5):
-        """检索向量数据库"""
+        return len(new_ids)
+
+    def search(self, query, top_k=5, embedding=None):
+        """
+        检索向量数据库
+
+        :param embedding: 已算好的查询向量，提供时不再调用 embedding_fn
+        """
+        if embedding is None:
+            embedding = self.embedding_fn([query])[0]
+        return self.search_by_embedding(embedding, top_k)
+
+    def search_by_embedding(self, embedding, top_k=5):
+        """用已算好的查询向量检索，供异步流程在事件循环外先批量计算向量"""
         results = self.collection.query(
-            query_embeddings=self.embedding_fn([query]),
-            n_results=top_k
+            query_embeddings=[_to_list(embedding)],
+            n_results=top_k,
+            where=self._where()
         )
         return results
 
+    def get_documents(self, batch_size=5000):
+        """当前文档（未指定文档时为整个 collection）的全部片段，返回含 ids、documents、metadatas 的字典"""
+        result = {'ids': [], 'documents': [], 'metadatas': []}
+        offset = 0
+        while True:
+            batch = self.collection.get(where=self._where(), include=['documents', 'metadatas'],
+                                        limit=batch_size, offset=offset)
+            for key in result:
+                result[key].extend(batch[key])
+            if len(batch['ids']) < batch_size:
+                return result
+            offset += batch_size
+
+    def list_documents(self, batch_size=5000):
+        """列出 collection 中的文档指纹及各自的片段数"""
+        counts = {}
+        offset = 0
+        while True:
+            batch = self.collection.get(include=['metadatas'], limit=batch_size, offset=offset)
+            for meta in batch['metadatas']:
+                doc_id = (meta or {}).get('doc_id')
+                counts[doc_id] = counts.get(doc_id, 0) + 1
+            if len(batch['ids']) < batch_size:
+                return counts
+            offset += batch_size
+
+    def drop_document(self, doc_id=None):
+        """删除一个文档的全部片段"""
+        where = self._where(doc_id)
+        if where is None:
+            raise ValueError("drop_document 需要指定 doc_id")
+        self.collection.delete(where=where)
+        chunks_removed("chroma", self.collection_name, where['doc_id'])
+
+    def compact_document(self, documents, doc_id=None):
+        """
+        只保留与 documents 内容一致的片段，删除该文档旧版本遗留的片段
+
+        :return: 删除的片段数
+        """
+        where = self._where(doc_id)
+        if where is None:
+            raise ValueError("compact_document 需要指定 doc_id")
+        keep = {chunk_fingerprint(where['doc_id'], doc) for doc in documents}
+        stale = [i for i in self.collection.get(where=where, include=[])['ids'] if i not in keep]
+        if stale:
+            self.collection.delete(ids=stale)
+            chunks_removed("chroma", self.collection_name, where['doc_id'], stale)
+        return len(stale)
+
+def make_vector_db(collection_name, embedding_fn, doc_id=None, backend=vector_backend, path=local_vector_db_path):
+    """
+    按 backend 创建向量库连接器，三种连接器接口一致
+
+    :param backend: chroma（服务端）、numpy（嵌入式精确检索）或 faiss（嵌入式近似检索）
+    :param path: 嵌入式向量库的存放目录，chroma 不使用
+    """
+    if backend == "chroma":
+        return MyVectorDBConnector(collection_name, embedding_fn, doc_id=doc_id)
+    # 嵌入式向量库按需导入，不使用时不必安装 faiss
+    if backend == "numpy":
+        from NumpyVectorDB import NumpyVectorDBConnector
+        return NumpyVectorDBConnector(collection_name, embedding_fn, doc_id=doc_id, path=path)
+    if backend == "faiss":
+        from FaissVectorDB import FaissVectorDBConnector
+        return FaissVectorDBConnector(collection_name, embedding_fn, doc_id=doc_id, path=path)
+    raise ValueError(f"未知的向量库: {backend}")
+
 class MyClass:
     def __init__(self, name):
         self.name = name
 
     def greet(self):
-        return f"Hello, {self.name}!"
\ No newline at end of file
+        return f"Hello, {self.name}!"
@@ -1,8 +1,14 @@
 import streamlit as st
 
-from mybase import extract_text_from_pdf, get_embeddings, get_completion
-from VectorDB import MyVectorDBConnector
+from mybase import get_embeddings, get_completion, get_completion_stream, get_answer_cache
+from VectorDB import make_vector_db
 from RAG_Bot import RAG_Bot
+from hybrid_retriever import HybridRetriever, get_keyword_index
+from chinese_utils import get_tokenizer
+from ingest_worker import IngestWorker
+from doc_registry import get_registry
+from reranker import get_reranker
+from conf import collection_name, rerank_candidates, ingest_first_batch_timeout
 
 
 def get_ai_response(user_input):
@@ -16,29 +22,74 @@ def get_ai_response(user_input):
     else:
         return "请先上传PDF文件"
 
-def chat_interface(pdf_file, user_input):
+def get_ai_response_stream(user_input):
+    """流式获取AI响应，逐段 yield 文本"""
+    if 'pdf_file' in st.session_state:
+        try:
+            yield from chat_interface_stream(st.session_state.pdf_file, user_input)
+        except Exception as e:
+            yield f"处理问题时发生错误: {str(e)}"
+    else:
+        yield "请先上传PDF文件"
+
+def get_vector_db(doc_id):
+    """文档的检索器：向量检索与关键词检索混合，关键词索引在入库时同时建立，进程重启后从向量库重建"""
+    vector_db = make_vector_db(collection_name, get_embeddings, doc_id=doc_id)
+    return HybridRetriever(vector_db, get_keyword_index(collection_name, doc_id, vector_db))
+
+@st.cache_resource
+def get_ingest_worker():
     """
-    聊天接口函数
+    所有会话共用的后台入库，进度记录在文档登记表中，每批新片段写入后该文档缓存的回答作废
     """
-    # 检查PDF是否已处理
-    if 'pdf_processed' not in st.session_state or not st.session_state.pdf_processed:
-        # 从PDF提取文本，提取所有页码
-        paragraphs = extract_text_from_pdf(pdf_file, [0, st.session_state.num_pages-1], min_line_length=10)
-        
+    # 在入库线程启动前加载分词词典，第一批片段建立关键词索引时不必等待
+    get_tokenizer()
+    return IngestWorker(get_vector_db, on_batch_stored=lambda doc_id, added: get_answer_cache().invalidate(doc_id),
+                        registry=get_registry())
 
-        # 使用自定义向量数据库
-        vector_db = MyVectorDBConnector("demo1", get_embeddings)
-        vector_db.add_documents(paragraphs)
+def start_ingest(pdf_file):
+    """
+    提交PDF的后台入库任务，同一文件（按内容指纹）只入库一次，返回 IngestJob
 
-        # 标记PDF已处理
-        st.session_state.pdf_processed = True
-    else:
-        # 重新创建向量数据库连接
-        vector_db = MyVectorDBConnector("demo1", get_embeddings)
+    入库失败的文件在重新上传时才重试，页面重跑时返回失败的任务，由调用方显示 job.error
+    """
+    upload_id = getattr(pdf_file, 'file_id', None)
+    retry = st.session_state.get('ingest_upload_id') != upload_id
+    st.session_state.ingest_upload_id = upload_id
+    # 按文件内容区分文档，同一文件在所有会话中只入库一次；submit 负责在登记表中登记
+    job = get_ingest_worker().submit(pdf_file, name=getattr(pdf_file, 'name', None), retry_failed=retry)
+    st.session_state.doc_id = job.doc_id
+    return job
 
-    # 创建一个RAG机器人
-    bot = RAG_Bot(vector_db, llm_api=get_completion)
+def get_bot(pdf_file):
+    """
+    为PDF创建RAG机器人，入库未完成时基于已写入的片段回答
+    """
+    job = start_ingest(pdf_file)
+    vector_db = get_vector_db(job.doc_id)
+
+    # 一个片段都还没写入时，等第一批写入（或入库结束）再检索
+    if not job.done and vector_db.count_documents() == 0:
+        with st.spinner("正在解析PDF..."):
+            job.wait(lambda j: j.chunks_stored > 0, timeout=ingest_first_batch_timeout)
+    if job.status == "failed":
+        raise RuntimeError(f"PDF 入库失败: {job.error}")
 
+    # 入库完成前检索结果还会变化，不使用答案缓存
+    return RAG_Bot(vector_db, llm_api=get_completion, llm_stream_api=get_completion_stream,
+                   answer_cache=get_answer_cache() if job.done else None,
+                   reranker=get_reranker(), n_candidates=rerank_candidates)
+
+def chat_interface(pdf_file, user_input):
+    """
+    聊天接口函数
+    """
     # 获取回答
-    response = bot.chat(user_input)
-    return response
\ No newline at end of file
+    response = get_bot(pdf_file).chat(user_input)
+    return response
+
+def chat_interface_stream(pdf_file, user_input):
+    """
+    流式聊天接口函数
+    """
+    yield from get_bot(pdf_file).stream_chat(user_input)
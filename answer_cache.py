@@ -0,0 +1,176 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from distance import normalize_rows
+from embedding_cache import normalize_text
+
+
+def normalize_query(query):
+    '''问题的归一化形式：统一全半角和空白、忽略大小写和结尾的标点'''
+    return re.sub(r'[\s?？!！。.,，、~～]+$', '', normalize_text(query).lower())
+
+
+class _Entry:
+    __slots__ = ('doc_id', 'query', 'answer', 'embedding', 'created')
+
+    def __init__(self, doc_id, query, answer, embedding):
+        self.doc_id = doc_id
+        self.query = query
+        self.answer = answer
+        self.embedding = embedding
+        self.created = time.time()
+
+
+class AnswerCache:
+    """
+    进程内的问答缓存，按 (文档指纹, 问题) 缓存 LLM 的回答
+
+    归一化后完全相同的问题直接命中；否则用问题向量与同一文档下已缓存问题的余弦相似度判断，
+    超过阈值即视为同一个问题。条目超过 ttl 秒过期，超出条数上限时淘汰最久未使用的。
+    文档的片段发生变化后需调用 invalidate(doc_id)，以免返回基于旧内容的回答。
+    """
+    def __init__(self, max_entries=1000, ttl=24 * 3600, similarity_threshold=0.95):
+        """
+        :param max_entries: 最多缓存的回答数
+        :param ttl: 条目的存活时间（秒），None 表示不过期
+        :param similarity_threshold: 语义命中的余弦相似度阈值，None 表示只做精确匹配
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # 每个文档已缓存问题的单位向量矩阵，条目变化时置空，下次查询时重建
+        self._matrices = {}
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def _expired(self, entry, now):
+        return self.ttl is not None and now - entry.created > self.ttl
+
+    def _reset_matrices(self, doc_id):
+        for key in [k for k in self._matrices if k[0] == doc_id]:
+            del self._matrices[key]
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._reset_matrices(entry.doc_id)
+
+    def _semantic_match(self, doc_id, embedding, now):
+        dim = len(embedding)
+        matrix = self._matrices.get((doc_id, dim))
+        if matrix is None:
+            # 只和同一维度的向量比较（换了 Embedding 模型后旧条目不参与语义匹配）
+            keys = [k for k, e in self._entries.items()
+                    if e.doc_id == doc_id and e.embedding is not None and len(e.embedding) == dim]
+            if not keys:
+                return None
+            matrix = self._matrices[(doc_id, dim)] = (keys, np.stack([self._entries[k].embedding for k in keys]))
+        keys, vectors = matrix
+        scores = vectors @ normalize_rows([embedding])[0]
+        for i in np.argsort(-scores):
+            if scores[i] < self.similarity_threshold:
+                break
+            entry = self._entries[keys[i]]
+            if not self._expired(entry, now):
+                return keys[i]
+        return None
+
+    def get(self, doc_id, query):
+        '''只做精确匹配，返回缓存的回答，未命中时返回 None（未命中由随后的 match 计数）'''
+        now = time.time()
+        key = (doc_id, normalize_query(query))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry, now):
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            self.exact_hits += 1
+            return entry.answer
+
+    def match(self, doc_id, embedding):
+        '''
+        按问题向量做语义匹配，返回缓存的回答，未命中时返回 None
+
+        :param embedding: 问题向量，为 None 或未开启语义匹配时只记一次未命中
+        '''
+        if embedding is not None and self.similarity_threshold is not None:
+            embedding = np.asarray(embedding, dtype=np.float32)
+            with self._lock:
+                match = self._semantic_match(doc_id, embedding, time.time())
+                if match is not None:
+                    self._entries.move_to_end(match)
+                    self.semantic_hits += 1
+                    return self._entries[match].answer
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def lookup(self, doc_id, query, embed_fn=None):
+        '''
+        查找缓存的回答，先精确匹配再语义匹配
+
+        :param embed_fn: 计算问题向量的函数，精确匹配未命中且开启语义匹配时才调用
+        :return: (回答, 问题向量)，未命中时回答为 None，未计算向量时向量为 None
+        '''
+        answer = self.get(doc_id, query)
+        if answer is not None:
+            return answer, None
+        embedding = None
+        if embed_fn is not None and self.similarity_threshold is not None:
+            embedding = np.asarray(embed_fn([query])[0], dtype=np.float32)
+        return self.match(doc_id, embedding), embedding
+
+    def put(self, doc_id, query, answer, embedding=None):
+        '''缓存一个回答，embedding 为问题向量，提供后才能被语义匹配命中'''
+        if embedding is not None:
+            embedding = normalize_rows([embedding])[0]
+        key = (doc_id, normalize_query(query))
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _Entry(doc_id, query, answer, embedding)
+            self._reset_matrices(doc_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, doc_id=None):
+        '''删除一个文档（doc_id 为 None 时为全部文档）的缓存回答，返回删除的条数'''
+        with self._lock:
+            if doc_id is None:
+                keys = list(self._entries)
+            else:
+                keys = [k for k, e in self._entries.items() if e.doc_id == doc_id]
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def stats(self):
+        '''命中统计'''
+        with self._lock:
+            hits = self.exact_hits + self.semantic_hits
+            total = hits + self.misses
+            return {
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+            }
@@ -0,0 +1,71 @@
+"""
+对比同步 RAG_Bot 串行处理与 AsyncRAGBot 并发处理的吞吐量
+
+全部请求发往本地模拟的 OpenAI 接口，不需要联网：
+    python benchmark_rag.py --questions 50 --latency 0.2
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from mock_openai_server import start_mock_server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG 吞吐量压测")
+    parser.add_argument("--questions", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.2, help="模拟接口每个请求的延迟（秒）")
+    parser.add_argument("--rewrites", type=int, default=2, help="AsyncRAGBot 的改写查询数")
+    args = parser.parse_args()
+
+    server, base_url = start_mock_server(latency=args.latency)
+    # client 在第一次使用时创建，必须先设置好模拟接口的地址
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ["OPENAI_API_KEY"] = "mock"
+    import mybase
+    from embedding_cache import EmbeddingCache
+    from NumpyVectorDB import NumpyVectorDBConnector
+    from RAG_Bot import AsyncRAGBot, RAG_Bot
+    from resources import set_resource
+
+    with tempfile.TemporaryDirectory() as tmp:
+        def fresh_cache(name):
+            '''每轮使用新的空向量缓存，各轮的问题向量都要调用接口，结果可比；也不会写入真实的向量缓存'''
+            set_resource("embedding_cache", EmbeddingCache(os.path.join(tmp, f"{name}.sqlite3")),
+                         close=EmbeddingCache.close)
+
+        fresh_cache("documents")
+        db = NumpyVectorDBConnector("bench", mybase.get_embeddings, doc_id="bench", path=tmp)
+        db.add_documents([f"第 {i} 段文档内容" for i in range(1000)])
+
+        questions = [f"第 {i} 个问题是什么？" for i in range(args.questions)]
+        bot = RAG_Bot(db, mybase.get_completion)
+        fresh_cache("serial")
+        # 预热：建立连接等一次性开销不计入耗时
+        bot.chat("预热")
+        start = time.perf_counter()
+        for q in questions:
+            bot.chat(q)
+        serial = time.perf_counter() - start
+        print(f"RAG_Bot 串行: {serial:.2f} s, {len(questions) / serial:.1f} 问/秒")
+
+        async def run():
+            # 各轮在同一个事件循环中执行，共用的异步 client 的连接池不能跨事件循环复用
+            for n_rewrites in (0, args.rewrites):
+                fresh_cache(f"async-{n_rewrites}")
+                abot = AsyncRAGBot(db, mybase.aget_completion, mybase.aget_embeddings, n_rewrites=n_rewrites)
+                await abot.chat("预热")
+                start = time.perf_counter()
+                await asyncio.gather(*(abot.chat(q) for q in questions))
+                elapsed = time.perf_counter() - start
+                print(f"AsyncRAGBot 并发 (改写 {n_rewrites} 条): {elapsed:.2f} s, "
+                      f"{len(questions) / elapsed:.1f} 问/秒")
+
+        asyncio.run(run())
+    server.shutdown()
+
+
+if "__main__" == __name__:
+    main()
@@ -1,97 +1,25 @@
 import streamlit as st
-import base64
-import tempfile
-import os
-import time
-import fitz  # PyMuPDF
-from PIL import Image
-import io
 import logging
 import streamlit.components.v1 as components
-from datetime import datetime
 
 # 设置日志级别
 logging.basicConfig(level=logging.INFO)
 
 # 导入自定义模块
-from mybase import extract_text_from_pdf
-from mybase import get_embeddings
-from mybase import get_completion
-from VectorDB import MyVectorDBConnector
-from RAG_Bot import RAG_Bot
+from ai_interface import get_ai_response_stream, start_ingest
+from page_cache import get_page_cache
 
-@st.cache_data
-def load_page(_pdf_document, page_num, scale=2):
+def load_page(doc_id, page_num, scale=2, source=None):
     """
-    加载PDF页面并转换为图像
-    
-    :param _pdf_document: PDF文档对象
+    加载PDF页面图像，按 (文档指纹, 页码, 缩放比例) 缓存，并在后台预取相邻页
+
+    :param doc_id: page_cache 中打开的文档指纹
     :param page_num: 页码
     :param scale: 缩放比例
-    :return: 页面图像
-    """
-    page = _pdf_document.load_page(page_num)
-    pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), alpha=False)
-    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-    return img
-
-def pdf_to_images(uploaded_file, num_pages_to_load=5):
+    :param source: 上传的文件，文档被其他会话打开的文档淘汰时用它重新打开
+    :return: 页面图像（PNG 字节）
     """
-    将上传的PDF文件转换为图像
-    
-    :param uploaded_file: 上传的PDF文件
-    :param num_pages_to_load: 要加载的页面数量
-    :return: 加载的页面和总页数
-    """
-    # 创建临时文件
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-        tmp_file.write(uploaded_file.getvalue())
-        tmp_file_path = tmp_file.name
-
-    # 打开PDF文档
-    pdf_document = fitz.open(tmp_file_path)
-    total_pages = len(pdf_document)
-
-    # 只加载指定数量的页面
-    loaded_pages = {}
-    for page_num in range(min(num_pages_to_load, total_pages)):
-        loaded_pages[page_num] = load_page(pdf_document, page_num)
-
-    # 关闭PDF文档并删除临时文件
-    pdf_document.close()
-    os.unlink(tmp_file_path)
-    
-    return loaded_pages, total_pages
-
-# 添加一个新的会话状态变量来跟踪PDF是否已处理
-if 'pdf_processed' not in st.session_state:
-    st.session_state.pdf_processed = False
-
-def chat_interface(pdf_file, user_input):
-    """
-    聊天接口函数
-    """
-    # 检查PDF是否已处理
-    if 'pdf_processed' not in st.session_state or not st.session_state.pdf_processed:
-        # 从PDF提取文本
-        paragraphs = extract_text_from_pdf(pdf_file, [0, 1], min_line_length=10)
-
-        # 使用自定义向量数据库
-        vector_db = MyVectorDBConnector("demo1", get_embeddings)
-        vector_db.add_documents(paragraphs)
-
-        # 标记PDF已处理
-        st.session_state.pdf_processed = True
-    else:
-        # 重新创建向量数据库连接
-        vector_db = MyVectorDBConnector("demo1", get_embeddings)
-
-    # 创建一个RAG机器人
-    bot = RAG_Bot(vector_db, llm_api=get_completion)
-
-    # 获取回答
-    response = bot.chat(user_input)
-    return response
+    return get_page_cache().get(doc_id, page_num, scale, source=source)
 
 def pdf_viewer():
     """
@@ -266,12 +194,9 @@ def main():
             with messages.chat_message("user"):
                 st.markdown(user_input)
             
-            # 使用spinner显示加载动画
-            with st.spinner("AI正在思考中..."):
-                # 获取并显示AI响应
-                response = get_ai_response(user_input)
-                with messages.chat_message("assistant"):
-                    st.markdown(response)
+            # 流式显示AI响应，边生成边显示
+            with messages.chat_message("assistant"):
+                response = st.write_stream(get_ai_response_stream(user_input))
 
             # 更新聊天历史
             st.session_state.chat_history.append(f"user: {user_input}")
@@ -285,29 +210,24 @@ def handle_pdf_upload():
     uploaded_file = st.file_uploader("上传PDF文件", type="pdf")
     if uploaded_file is not None:
         try:
-            if 'pdf_file' not in st.session_state or st.session_state.pdf_file != uploaded_file:
-                st.session_state.pdf_file = uploaded_file
-                loaded_pages, total_pages = pdf_to_images(uploaded_file)
-                st.session_state.loaded_pages = loaded_pages
-                st.session_state.total_pages = total_pages
-            
-            for page_num, img in st.session_state.loaded_pages.items():
-                st.image(img, caption=f"第 {page_num + 1} 页", use_column_width=True)
+            st.session_state.pdf_file = uploaded_file
+            # 按内容指纹登记并在后台入库，同一文件在所有会话中只处理一次
+            job = start_ingest(uploaded_file)
+            if job.status == "failed":
+                st.error(f"PDF 入库失败: {job.error}")
+            # 直接从内存打开，同一文件只打开一次
+            doc_id = get_page_cache().open(uploaded_file, job.doc_id)
+            total_pages = get_page_cache().page_count(doc_id, uploaded_file)
+            st.session_state.total_pages = total_pages
+
+            # 只渲染当前页，相邻页在后台预取
+            page_num = st.number_input("页码", min_value=1, max_value=total_pages, value=1, key="page_num")
+            st.image(load_page(doc_id, page_num - 1, source=uploaded_file), caption=f"第 {page_num} 页 / 共 {total_pages} 页",
+                     use_column_width=True)
 
         except Exception as e:
             st.error(f"加载PDF时发生错误: {str(e)}")
 
-def get_ai_response(user_input):
-    if 'pdf_file' in st.session_state:
-        try:
-            # 获取AI响应
-            response = chat_interface(st.session_state.pdf_file, user_input)
-            return response
-        except Exception as e:
-            return f"处理问题时发生错误: {str(e)}"
-    else:
-        return "请先上传PDF文件"
-
 if __name__ == "__main__":
     if "get_pdf_data" in st.query_params:
         pdf_data = get_pdf_data()
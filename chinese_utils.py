@@ -1,19 +1,114 @@
+import functools
+import logging
+import multiprocessing
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
+
 import jieba
-import nltk
-from nltk.corpus import stopwords
 
-nltk.download('stopwords')  
+from conf import jieba_cache_dir, keyword_workers
+from resources import get_resource
+
+_here = os.path.dirname(os.path.abspath(__file__))
+# 项目自带的中文停用词表，不再在导入时联网下载 nltk 语料
+stopwords_path = os.path.join(_here, 'data', 'stopwords_zh.txt')
+# 前缀词典缓存到项目的缓存目录（相对路径按项目目录解析，与启动时的工作目录无关），之后的进程直接加载缓存
+cache_dir = os.path.normpath(os.path.join(_here, jieba_cache_dir))
+
+
+def load_stopwords(path=stopwords_path):
+    """读取停用词表，每行一个词"""
+    with open(path, encoding='utf-8') as f:
+        return frozenset(line.strip() for line in f if line.strip())
+
+
+# 停用词表只在导入时加载一次
+stop_words = load_stopwords()
+
+jieba.setLogLevel(logging.WARNING)
+
+
+def initialize():
+    """加载 jieba 词典，返回分词器；通过 get_tokenizer 调用，进程内只加载一次"""
+    os.makedirs(cache_dir, exist_ok=True)
+    jieba.dt.tmp_dir = cache_dir
+    jieba.initialize()
+    return jieba.dt
+
+
+def get_tokenizer():
+    """
+    进程内共享的 jieba 分词器，第一次调用时同步加载词典
+
+    导入本模块不再启动加载线程：在加载中途 fork 的子进程会继承被占用的锁。
+    需要提前加载时（如应用启动、创建进程池之前）显式调用一次。
+    """
+    return get_resource("jieba", initialize)
+
+
+def _shutdown_pool(pool):
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def get_keyword_pool(workers):
+    """
+    批量分词的进程池，进程内只有一个，常驻复用，不必每批文本都启动进程、加载词典
 
+    进程数由第一次创建时的 workers 决定。用 spawn 方式启动子进程，在多线程进程中也可以安全使用
+    """
+    return get_resource("keyword_pool", lambda: ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=get_tokenizer),
+        close=_shutdown_pool)
+
+
+# to_keywords_many 默认的分词进程数
+_default_workers = keyword_workers
+
+
+def set_keyword_workers(workers):
+    """设置 to_keywords_many 默认的分词进程数，批量入库等独占机器的场景调用"""
+    global _default_workers
+    _default_workers = max(1, workers)
+
+# 至少包含一个字母、数字或汉字的词才作为检索词，去掉标点和空白
+_WORD = re.compile(r'\w')
+
+
+def _to_keywords(input_string):
+    # 按搜索引擎模式分词，去除停用词和标点
+    words = get_tokenizer().cut_for_search(input_string)
+    return ' '.join(w for w in words if w not in stop_words and _WORD.search(w))
+
+
+@functools.lru_cache(maxsize=4096)
 def to_keywords(input_string):
-    """将句子转成检索关键词序列"""
-    # 按搜索引擎模式分词
-    word_tokens = jieba.cut_for_search(input_string)
-    # 加载停用词表
-    stop_words = set(stopwords.words('chinese'))
-    # 去除停用词
-    filtered_sentence = [w for w in word_tokens if not w in stop_words]
-    return ' '.join(filtered_sentence)
+    """将句子转成检索关键词序列，相同的输入直接返回缓存结果"""
+    return _to_keywords(input_string)
+
+
+def to_keywords_many(texts, workers=None, min_parallel=32, chunksize=None):
+    """
+    批量将文本转成检索关键词序列，返回与 texts 等长的列表
+
+    :param workers: 分词进程数，None 表示 conf.keyword_workers（或 set_keyword_workers 设置的值），1 表示在当前进程中执行
+    :param min_parallel: 文本数少于该值时不启用多进程，进程间传输的开销大于分词本身
+    :param chunksize: 每次发给子进程的文本数，None 表示按进程数均分
+    """
+    texts = list(texts)
+    # PDF 中重复的页眉页脚等只分词一次
+    unique = list(dict.fromkeys(texts))
+    workers = workers or _default_workers
+    if workers <= 1 or len(unique) < min_parallel:
+        results = [_to_keywords(t) for t in unique]
+    else:
+        chunksize = chunksize or -(-len(unique) // (workers * 4))
+        results = list(get_keyword_pool(workers).map(_to_keywords, unique, chunksize=chunksize))
+    if len(unique) == len(texts):
+        return results
+    lookup = dict(zip(unique, results))
+    return [lookup[t] for t in texts]
+
 
 def sent_tokenize(input_string):
     """按标点断句"""
@@ -24,7 +119,29 @@ def sent_tokenize(input_string):
 
     
 if "__main__" == __name__:
+    from utils.timer import Timer
+
     # 测试关键词提取
     print(to_keywords("小明硕士毕业于中国科学院计算所，后在日本京都大学深造"))
     # 测试断句
-    print(sent_tokenize("这是，第一句。这是第二句吗？是的！啊"))
\ No newline at end of file
+    print(sent_tokenize("这是，第一句。这是第二句吗？是的！啊"))
+
+    # 对比：每次调用都重新加载停用词表（原实现）与批量分词
+    texts = [f"第 {i} 段：小明硕士毕业于中国科学院计算所，后在日本京都大学深造，研究检索增强生成。" * 4
+             for i in range(20000)]
+    with Timer("逐条分词并重新加载停用词表 (2000 段)"):
+        for t in texts[:2000]:
+            words = load_stopwords()
+            ' '.join(w for w in jieba.cut_for_search(t) if w not in words)
+    with Timer("to_keywords_many 单进程 (2000 段)"):
+        to_keywords_many(texts[:2000], workers=1)
+    with Timer("to_keywords_many 单进程 (20000 段)"):
+        single = to_keywords_many(texts, workers=1)
+    with Timer("to_keywords_many 多进程 (20000 段)"):
+        parallel = to_keywords_many(texts, workers=os.cpu_count())
+    print("结果一致:", single == parallel)
+    # 进程池常驻后，入库时一批几十个片段也能并行分词
+    with Timer("to_keywords_many 单进程 (64 段)"):
+        to_keywords_many(texts[-64:], workers=1)
+    with Timer("to_keywords_many 多进程 (64 段)"):
+        to_keywords_many(texts[-64:], workers=os.cpu_count())
@@ -0,0 +1,147 @@
+import re
+from typing import NamedTuple
+
+from chinese_utils import sent_tokenize
+from conf import chunk_max_tokens, chunk_overlap_tokens
+from pdf_extractor import iter_paragraphs
+from utils.tokens import count_tokens
+
+
+class Chunk(NamedTuple):
+    """带出处信息的文本片段"""
+    text: str
+    page: int      # 起始页码（从 0 开始）
+    end_page: int  # 结束页码
+    offset: int    # 第一句在起始页文本中的大致字符位置
+    tokens: int
+    index: int     # 片段在文档中的序号
+
+    def metadata(self):
+        '''写入向量库的 metadata'''
+        return {"page": self.page, "end_page": self.end_page, "offset": self.offset, "index": self.index}
+
+
+class _Sentence(NamedTuple):
+    text: str
+    page: int
+    offset: int
+    tokens: int
+    paragraph_start: bool
+
+
+# sent_tokenize 只按中文标点断句，英文句末（后跟空白的 .!?）另外切分
+_EN_SENTENCE_END = re.compile(r'(?<=[.!?])(?=\s)')
+# 仍然过长的句子再按逗号、分号、冒号切分
+_CLAUSE_END = re.compile(r'(?<=[,;:，、；：])')
+
+
+def _split_long(text, max_tokens, model):
+    '''按英文句末切分，超出预算的句子再切成不超过预算的几段，找不到标点时按字符硬切'''
+    pieces = [p for p in _EN_SENTENCE_END.split(text) if p]
+    pieces = [p for piece in pieces
+              for p in (_CLAUSE_END.split(piece) if count_tokens(piece, model) > max_tokens else [piece]) if p]
+    result = []
+    for piece in pieces:
+        n = count_tokens(piece, model)
+        if n <= max_tokens:
+            result.append(piece)
+            continue
+        step = max(1, len(piece) * max_tokens // n)
+        result.extend(piece[i:i + step] for i in range(0, len(piece), step))
+    return result
+
+
+def _iter_sentences(paragraphs, max_tokens, model):
+    for para in paragraphs:
+        pos = 0
+        first = True
+        for sentence in sent_tokenize(para.text):
+            start = para.text.find(sentence, pos)
+            pos = start + len(sentence)
+            for piece in _split_long(sentence, max_tokens, model):
+                yield _Sentence(piece, para.page, para.offset + start, count_tokens(piece, model), first)
+                start += len(piece)
+                first = False
+
+
+def _make_chunk(sentences, index):
+    parts = []
+    for s in sentences:
+        if s.paragraph_start and parts:
+            parts.append('\n' + s.text.lstrip())
+        else:
+            parts.append(s.text)
+    return Chunk(''.join(parts).strip(), sentences[0].page, sentences[-1].page, sentences[0].offset,
+                 sum(s.tokens for s in sentences), index)
+
+
+def iter_chunks(paragraphs, max_tokens=chunk_max_tokens, overlap_tokens=chunk_overlap_tokens,
+                model="text-embedding-ada-002", start_index=0):
+    """
+    把段落流按句子打包成 token 数接近上限的片段，逐个 yield Chunk
+
+    片段可以跨段落和页，段落之间用换行分隔；相邻片段共享末尾不超过 overlap_tokens 的整句。
+
+    :param paragraphs: Paragraph 的可迭代对象，如 pdf_extractor.iter_paragraphs 的输出
+    :param max_tokens: 每个片段的 token 上限
+    :param overlap_tokens: 相邻片段重叠的 token 数上限，必须小于 max_tokens
+    :param model: 计算 token 数使用的模型
+    :param start_index: 第一个片段的序号，从检查点继续切片时接着已有的片段编号
+    """
+    if not 0 <= overlap_tokens < max_tokens:
+        raise ValueError("overlap_tokens 必须小于 max_tokens")
+    buffer = []
+    tokens = 0
+    index = start_index
+    # buffer 中不属于上一片段重叠部分的句子数，为 0 时不单独输出
+    fresh = 0
+    for sentence in _iter_sentences(paragraphs, max_tokens, model):
+        if fresh and tokens + sentence.tokens > max_tokens:
+            yield _make_chunk(buffer, index)
+            index += 1
+            # 保留末尾的几句作为重叠，同时保证放得下当前句
+            keep, kept = [], 0
+            for s in reversed(buffer):
+                if kept + s.tokens > overlap_tokens:
+                    break
+                keep.insert(0, s)
+                kept += s.tokens
+            while keep and kept + sentence.tokens > max_tokens:
+                kept -= keep.pop(0).tokens
+            buffer, tokens, fresh = keep, kept, 0
+        buffer.append(sentence)
+        tokens += sentence.tokens
+        fresh += 1
+    if fresh:
+        yield _make_chunk(buffer, index)
+
+
+def chunk_pdf(source, page_numbers=None, min_line_length=1, max_tokens=chunk_max_tokens,
+              overlap_tokens=chunk_overlap_tokens, start_index=0, **kwargs):
+    """
+    从 PDF 中流式提取并切片，参数同 pdf_extractor.iter_paragraphs 与 iter_chunks
+
+    :param kwargs: 传给 iter_paragraphs 的其他参数，如 workers
+    """
+    paragraphs = iter_paragraphs(source, page_numbers, min_line_length, **kwargs)
+    return iter_chunks(paragraphs, max_tokens, overlap_tokens, start_index=start_index)
+
+
+if "__main__" == __name__:
+    import sys
+
+    import numpy as np
+
+    from utils.timer import Timer
+
+    # 与按空行分段的片段大小对比
+    path = sys.argv[1] if len(sys.argv) > 1 else "static/pdfjs/web/compressed.tracemonkey-pldi-09.pdf"
+    with Timer("按空行分段"):
+        paragraphs = list(iter_paragraphs(path, min_line_length=10))
+    with Timer("按 token 预算切片"):
+        chunks = list(iter_chunks(iter(paragraphs)))
+    for name, sizes in (("段落", [count_tokens(p.text) for p in paragraphs]), ("片段", [c.tokens for c in chunks])):
+        sizes = np.array(sizes)
+        print(f"{name}: {len(sizes)} 个, token 数 最小 {sizes.min()} 平均 {sizes.mean():.1f} "
+              f"最大 {sizes.max()} 标准差 {sizes.std():.1f}, 合计 {sizes.sum()}")
+    print(chunks[0])
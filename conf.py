@@ -1 +1,105 @@
-container_height = 550
\ No newline at end of file
+import hashlib
+import os
+import re
+
+container_height = 550
+
+# 调试模式：在侧边栏显示进程内共享资源的内存占用等管理信息，只供部署者排查问题
+debug = os.getenv("CHATPDF_DEBUG", "").lower() in ("1", "true", "yes")
+
+# 向量模型：openai 调用 OpenAI 接口，local 在本机 CPU 上用 sentence_transformers 计算
+embedding_backend = os.getenv("EMBEDDING_BACKEND", "openai")
+local_embedding_model = os.getenv("LOCAL_EMBEDDING_MODEL", "BAAI/bge-small-zh-v1.5")
+# OpenAI 向量模型及输出维度（None 为模型默认维度）
+openai_embedding_model = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-ada-002")
+openai_embedding_dimensions = int(os.getenv("OPENAI_EMBEDDING_DIMENSIONS", "0")) or None
+# 当前向量模型的标识，不同模型或维度的向量不能放在一起检索
+if embedding_backend == "local":
+    embedding_model_id = local_embedding_model
+elif openai_embedding_dimensions:
+    embedding_model_id = f"{openai_embedding_model}-{openai_embedding_dimensions}"
+else:
+    embedding_model_id = openai_embedding_model
+# 本地推理使用的线程数（None 为 torch 默认值）以及是否做 int8 动态量化
+local_embedding_threads = None
+local_embedding_quantize = False
+
+# 检索结果重排：设置模型名后启用 CrossEncoder 重排，先多取 rerank_candidates 个候选，
+# 重排超出 rerank_latency_budget 秒时只按已算出的得分调整这些片段的位置，其余保持向量检索的顺序；
+# rerank_workers 为打分线程数，多个会话同时提问时不必排在一个线程后面
+rerank_model = os.getenv("RERANK_MODEL")
+rerank_candidates = 8
+rerank_latency_budget = 0.5
+rerank_workers = 2
+
+# 向量数据库，不同文档按文档指纹隔离在同一个 collection 中；collection 按向量模型区分，
+# 切换模型后写入新的 collection，不会与旧模型的向量维度冲突（名称需符合 chroma 的规则：3~63 个字符）
+collection_name = (os.getenv("COLLECTION_NAME")
+                   or "chatpdf-" + re.sub(r'[^a-zA-Z0-9]+', '-', embedding_model_id).strip('-'))
+if len(collection_name) > 63:
+    collection_name = collection_name[:54] + '-' + hashlib.sha1(embedding_model_id.encode()).hexdigest()[:8]
+
+# 文档登记表：按文件内容指纹记录每个文档的处理进度，每个向量库的每个 collection 各有一份，存放在该目录下
+doc_registry_dir = "./cache"
+
+# 向量缓存
+embedding_cache_path = "./cache/embeddings.sqlite3"
+embedding_cache_max_bytes = 1024 * 1024 * 1024
+
+# 文本切片：每个片段的 token 上限，相邻片段重叠的 token 数
+chunk_max_tokens = 256
+chunk_overlap_tokens = 32
+
+# 每个模型放进提示词的上下文 token 预算，未列出的模型使用 default
+context_token_budgets = {"gpt-3.5-turbo": 3000, "gpt-4o-mini": 6000, "gpt-4o": 6000, "default": 2000}
+# 两个片段的字符三元组重合比例超过该值时视为重复，只保留排名靠前的
+context_dedup_threshold = 0.85
+
+# 后台入库：工作线程数，每批写入向量库的片段数，每个检查点包含的页数，首次提问时等待第一批片段写入的最长时间（秒）
+ingest_workers = 2
+ingest_batch_size = 64
+ingest_page_batch_size = 16
+ingest_first_batch_timeout = 60
+# 后台入库提取文字的进程数（以 spawn 方式启动，1 表示在工作线程中提取），每个提取任务包含的页数
+ingest_extract_workers = 2
+ingest_pages_per_task = 4
+
+# 页面渲染缓存：内存与磁盘容量上限（字节）、磁盘缓存目录、同时打开的文档数、前后预取的页数
+page_cache_max_bytes = 256 * 1024 * 1024
+page_cache_dir = "./cache/pages"
+page_cache_disk_max_bytes = 1024 * 1024 * 1024
+page_cache_max_documents = 4
+page_prefetch = 2
+
+# PDF 预览：单页 PDF 缓存的容量上限（字节），同时保留解析结果的文档数
+preview_cache_max_bytes = 64 * 1024 * 1024
+preview_max_documents = 4
+
+# 问答缓存：条数上限、存活时间（秒）、语义命中的相似度阈值
+answer_cache_max_entries = 1000
+answer_cache_ttl = 24 * 3600
+answer_cache_similarity = 0.95
+
+# 向量库：chroma 连接 chroma 服务，numpy / faiss 为存放在 local_vector_db_path 下的嵌入式向量库
+vector_backend = os.getenv("VECTOR_BACKEND", "chroma")
+
+# chroma 服务地址
+chroma_host = os.getenv("CHROMA_HOST", "localhost")
+chroma_port = int(os.getenv("CHROMA_PORT", "8000"))
+
+# jieba 前缀词典的缓存目录，默认的系统临时目录重启后会被清空
+jieba_cache_dir = "./cache"
+# 批量分词的进程数，1 表示在当前进程中分词；网页端保持 1，不在 streamlit 进程中启动进程池，
+# 批量入库（index_cli --keyword-workers）时再启用
+keyword_workers = int(os.getenv("KEYWORD_WORKERS", "1"))
+
+# Elasticsearch 地址，设置后关键词检索使用 Elasticsearch，否则使用进程内的 BM25 索引
+elasticsearch_url = os.getenv("ELASTICSEARCH_URL")
+# 进程内最多保留的关键词索引数（每个文档一个），超出时淘汰最久未用的，再次打开时从向量库重建
+keyword_index_max_documents = 32
+
+# 嵌入式向量库（NumpyVectorDB）的存放目录
+local_vector_db_path = "./local_vector_db"
+
+# faiss 近似检索索引（FaissVectorDB）的 index_factory 描述
+faiss_index_factory = "HNSW32"
@@ -0,0 +1,132 @@
+import re
+from typing import NamedTuple
+
+from conf import context_dedup_threshold, context_token_budgets
+from utils.tokens import count_tokens
+
+
+class PackedContext(NamedTuple):
+    """打包后放进提示词的上下文"""
+    texts: list      # 按相关性排好序的片段
+    tokens: int      # 上下文的 token 数
+    dropped: int     # 因重复或超出预算丢弃的片段数
+    merged: int      # 与同页前后相接的片段合并掉的片段数
+
+
+def token_budget(model):
+    '''模型的上下文 token 预算'''
+    return context_token_budgets.get(model, context_token_budgets["default"])
+
+
+def _shingles(text, n=3):
+    text = re.sub(r'\s+', '', text)
+    return {text[i:i + n] for i in range(max(len(text) - n + 1, 1))}
+
+
+def _is_duplicate(shingles, kept, threshold):
+    # 用重合部分占较短片段的比例判断，一个片段基本包含在另一个中时也算重复
+    for other in kept:
+        if len(shingles & other) / max(min(len(shingles), len(other)), 1) >= threshold:
+            return True
+    return False
+
+
+def _join_overlap(a, b, min_overlap=8):
+    '''a 的结尾与 b 的开头重叠（切片时的重叠部分）时返回拼接结果，否则返回 None'''
+    probe = b[:min_overlap]
+    if len(probe) < min_overlap:
+        return None
+    start = a.find(probe)
+    while start != -1:
+        if b.startswith(a[start:]):
+            return a[:start] + b
+        start = a.find(probe, start + 1)
+    return None
+
+
+def _adjacent(a, b):
+    '''按位置排好序的两个片段是否前后相接且在同一页上'''
+    if a.get('end_page', a['page']) != b['page']:
+        return False
+    if a.get('index') is not None and b.get('index') is not None:
+        return b['index'] == a['index'] + 1
+    return None
+
+
+def _merge_neighbours(items):
+    '''
+    合并同一页上前后相接的片段，合并后的片段排在其中排名最靠前的位置
+
+    有 index 的片段按序号判断是否相接，没有的（旧数据）按首尾是否有切片时的重叠判断
+
+    :param items: [(排名, 文本, metadata)]
+    :return: ([(排名, 文本)], 被合并掉的片段数)
+    '''
+    groups = {}
+    result = []
+    for rank, text, meta in items:
+        if meta and meta.get('page') is not None:
+            groups.setdefault(meta.get('doc_id'), []).append(
+                ((meta['page'], meta.get('offset', 0)), rank, text, meta))
+        else:
+            result.append((rank, text))
+    merged = 0
+    for members in groups.values():
+        members.sort(key=lambda m: m[0])
+        _, rank, text, meta = members[0]
+        for _, other_rank, other, other_meta in members[1:]:
+            adjacent = _adjacent(meta, other_meta)
+            joined = None
+            if adjacent is not False:
+                joined = _join_overlap(text, other)
+                if joined is None and adjacent:
+                    joined = text + '\n' + other
+            if joined is None:
+                result.append((rank, text))
+                rank, text = other_rank, other
+            else:
+                rank, text = min(rank, other_rank), joined
+                merged += 1
+            meta = other_meta
+        result.append((rank, text))
+    result.sort()
+    return result, merged
+
+
+def pack_context(documents, metadatas=None, model="gpt-3.5-turbo", max_tokens=None,
+                 dedup_threshold=context_dedup_threshold):
+    """
+    整理检索到的片段：去掉近似重复的片段，合并同页前后相接的片段，按相关性顺序放入不超过预算的片段
+
+    :param documents: 按相关性排好序的片段
+    :param metadatas: 片段的 metadata，含 page、offset 时才会合并相接的片段
+    :param model: 按模型取 conf.context_token_budgets 中的预算
+    :param max_tokens: 上下文 token 预算，提供时忽略 model 的预算
+    """
+    if max_tokens is None:
+        max_tokens = token_budget(model)
+    metadatas = metadatas or [None] * len(documents)
+
+    kept = []
+    kept_shingles = []
+    for rank, (text, meta) in enumerate(zip(documents, metadatas)):
+        shingles = _shingles(text)
+        if not _is_duplicate(shingles, kept_shingles, dedup_threshold):
+            kept.append((rank, text, meta))
+            kept_shingles.append(shingles)
+    items, merged = _merge_neighbours(kept)
+
+    texts = []
+    total = 0
+    for _, text in items:
+        n = count_tokens(text, model)
+        if total + n > max_tokens:
+            if texts:
+                # 放不下就跳过，后面更短的片段可能还放得下
+                continue
+            # 最相关的片段本身就超出预算时按比例截断
+            text = text[:max(1, len(text) * max_tokens // n)]
+            n = count_tokens(text, model)
+        texts.append(text)
+        total += n
+    return PackedContext(texts, total, len(documents) - merged - len(texts), merged)
@@ -0,0 +1,266 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+from conf import collection_name, doc_registry_dir, vector_backend
+from pdf_extractor import PageSet
+from resources import get_resource, resource_key
+from utils.fingerprint import file_fingerprint
+
+# 文档的处理状态
+PENDING = "pending"
+INDEXING = "indexing"
+INDEXED = "indexed"
+FAILED = "failed"
+
+_COLUMNS = ("doc_id", "name", "size", "num_pages", "status", "pages_extracted", "chunks",
+            "chunks_embedded", "chunks_stored", "error", "created", "updated")
+
+
+class DocumentState(NamedTuple):
+    """一个文档（按内容指纹区分）的处理进度"""
+    doc_id: str
+    name: Optional[str]
+    size: int
+    num_pages: int
+    status: str
+    pages_extracted: int
+    chunks: int
+    chunks_embedded: int
+    chunks_stored: int
+    error: Optional[str]
+    created: float
+    updated: float
+
+    @property
+    def indexed(self):
+        return self.status == INDEXED
+
+
+def format_pages(pages):
+    '''把 PageSet 写成 "0-15,32,40-47" 形式的文本'''
+    return ','.join(f'{r.start}-{r.stop - 1}' if len(r) > 1 else str(r.start) for r in pages.runs())
+
+
+def parse_pages(text, num_pages):
+    '''format_pages 的逆操作'''
+    pages = PageSet(num_pages, ())
+    for part in filter(None, (text or '').split(',')):
+        start, _, stop = part.partition('-')
+        pages.add(range(int(start), int(stop or start) + 1))
+    return pages
+
+
+def _size(source):
+    if isinstance(source, (str, os.PathLike)):
+        return os.path.getsize(source)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return memoryview(source).nbytes
+    size = getattr(source, 'size', None)
+    if size is None and hasattr(source, 'getbuffer'):
+        with source.getbuffer() as view:
+            size = view.nbytes
+    return size or 0
+
+
+def registry_path(backend=vector_backend, collection=collection_name):
+    '''
+    向量库 backend 中 collection 对应的登记表文件
+
+    登记表记录的是写入某个向量库的进度，其他向量库（如 index_cli --store numpy 写入的嵌入式向量库）
+    各用各的登记表，不会把网页端读取的向量库中不存在的文档标记为已入库
+    '''
+    return os.path.join(doc_registry_dir, f"documents-{backend}-{collection}.sqlite3")
+
+
+class DocumentRegistry:
+    """
+    文档登记表，以文件内容的 SHA-256 为文档 id，持久化在 SQLite 中
+
+    记录每个文档的提取、切片、向量化和入库进度。预览、入库、检索和答案缓存都用这里的 doc_id，
+    同一文件无论上传几次、在几个会话中打开，在一个部署中只处理一次。
+    """
+    def __init__(self, path=None, memo_size=256):
+        """
+        :param path: SQLite 文件路径，默认为当前向量库和 collection 的登记表
+        :param memo_size: 记住多少个上传对象的指纹，同一上传在每次重跑时不必重新计算哈希
+        """
+        path = path or registry_path()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.memo_size = memo_size
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            " doc_id TEXT PRIMARY KEY, name TEXT, size INTEGER NOT NULL DEFAULT 0,"
+            " num_pages INTEGER NOT NULL DEFAULT 0, status TEXT NOT NULL,"
+            " pages_extracted INTEGER NOT NULL DEFAULT 0, chunks INTEGER NOT NULL DEFAULT 0,"
+            " chunks_embedded INTEGER NOT NULL DEFAULT 0, chunks_stored INTEGER NOT NULL DEFAULT 0,"
+            " error TEXT, created REAL NOT NULL, updated REAL NOT NULL)")
+        # 入库检查点：已完成的页（format_pages 格式）和已写入向量库的片段
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(documents)")}
+        if 'pages_done' not in columns:
+            self._conn.execute("ALTER TABLE documents ADD COLUMN pages_done TEXT NOT NULL DEFAULT ''")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS stored_chunks ("
+            " doc_id TEXT NOT NULL, chunk_id TEXT NOT NULL, page INTEGER NOT NULL,"
+            " PRIMARY KEY (doc_id, chunk_id))")
+
+    def fingerprint(self, source):
+        '''
+        文档 id，streamlit 的上传对象按 file_id 记住结果，其他来源每次流式计算
+
+        :param source: 文件路径、bytes/memoryview 或文件对象
+        '''
+        upload_id = getattr(source, 'file_id', None)
+        if upload_id is None:
+            return file_fingerprint(source)
+        with self._lock:
+            doc_id = self._memo.get(upload_id)
+            if doc_id is not None:
+                self._memo.move_to_end(upload_id)
+                return doc_id
+        doc_id = file_fingerprint(source)
+        with self._lock:
+            self._memo[upload_id] = doc_id
+            while len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+        return doc_id
+
+    def register(self, source, name=None, doc_id=None):
+        '''
+        登记文档，已登记过的只返回 doc_id，不改变已有的进度
+
+        :param doc_id: 已算好的文档指纹，提供时不再计算
+        '''
+        doc_id = doc_id or self.fingerprint(source)
+        name = name or getattr(source, 'name', None) or (source if isinstance(source, str) else None)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO documents (doc_id, name, size, status, created, updated)"
+                " VALUES (?, ?, ?, ?, ?, ?)", (doc_id, name, _size(source), PENDING, now, now))
+        return doc_id
+
+    def get(self, doc_id):
+        '''返回 DocumentState，未登记时返回 None'''
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM documents WHERE doc_id=?", (doc_id,)).fetchone()
+        return DocumentState(*row) if row else None
+
+    def update(self, doc_id, **fields):
+        '''更新文档的处理进度，fields 为 DocumentState 中的字段'''
+        unknown = set(fields) - set(_COLUMNS[1:-2])
+        if unknown:
+            raise ValueError(f"未知字段: {', '.join(sorted(unknown))}")
+        fields['updated'] = time.time()
+        assignments = ', '.join(f"{k}=?" for k in fields)
+        with self._lock:
+            self._conn.execute(f"UPDATE documents SET {assignments} WHERE doc_id=?", (*fields.values(), doc_id))
+
+    def pages_done(self, doc_id, num_pages):
+        '''最近一次检查点时已完成的页，返回 PageSet'''
+        with self._lock:
+            row = self._conn.execute("SELECT pages_done FROM documents WHERE doc_id=?", (doc_id,)).fetchone()
+        return parse_pages(row[0] if row else '', num_pages)
+
+    def chunk_ids(self, doc_id):
+        '''检查点记录的已写入向量库的片段 id'''
+        with self._lock:
+            return {row[0] for row in self._conn.execute(
+                "SELECT chunk_id FROM stored_chunks WHERE doc_id=?", (doc_id,))}
+
+    def checkpoint(self, doc_id, pages, stored, **fields):
+        '''
+        一批页入库完成后提交检查点，在一个事务中记录这批页和写入的片段，并更新进度
+
+        :param pages: 这批完成的页（PageSet 或页码的可迭代对象）
+        :param stored: 这批写入的片段 [(片段 id, 页码), ...]
+        :param fields: 同时更新的进度字段，同 update
+        '''
+        unknown = set(fields) - set(_COLUMNS[1:-2])
+        if unknown:
+            raise ValueError(f"未知字段: {', '.join(sorted(unknown))}")
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                row = self._conn.execute(
+                    "SELECT pages_done, num_pages FROM documents WHERE doc_id=?", (doc_id,)).fetchone()
+                num_pages = max(fields.get('num_pages') or 0, row[1] if row else 0,
+                                max(pages, default=-1) + 1)
+                done = parse_pages(row[0] if row else '', num_pages).add(list(pages))
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO stored_chunks VALUES (?, ?, ?)",
+                    [(doc_id, chunk_id, page) for chunk_id, page in stored])
+                fields = dict(fields, pages_done=format_pages(done), updated=time.time())
+                assignments = ', '.join(f"{k}=?" for k in fields)
+                self._conn.execute(f"UPDATE documents SET {assignments} WHERE doc_id=?",
+                                   (*fields.values(), doc_id))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def reset(self, doc_id):
+        '''清空文档的检查点和进度，向量库中的片段被删除后调用，再次提交时从头入库'''
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute(
+                    "UPDATE documents SET status=?, pages_done='', pages_extracted=0, chunks=0, chunks_embedded=0,"
+                    " chunks_stored=0, error=NULL, updated=? WHERE doc_id=?", (PENDING, time.time(), doc_id))
+                self._conn.execute("DELETE FROM stored_chunks WHERE doc_id=?", (doc_id,))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def is_indexed(self, doc_id):
+        state = self.get(doc_id)
+        return state is not None and state.indexed
+
+    def list(self, status=None):
+        query = f"SELECT {', '.join(_COLUMNS)} FROM documents"
+        params = ()
+        if status is not None:
+            query += " WHERE status=?"
+            params = (status,)
+        with self._lock:
+            return [DocumentState(*row) for row in self._conn.execute(query + " ORDER BY created", params)]
+
+    def remove(self, doc_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM documents WHERE doc_id=?", (doc_id,))
+            self._conn.execute("DELETE FROM stored_chunks WHERE doc_id=?", (doc_id,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_registry(backend=vector_backend, collection=collection_name):
+    '''进程内共享的文档登记表，默认为 conf 中配置的向量库和 collection'''
+    path = registry_path(backend, collection)
+    return get_resource(resource_key("doc_registry", path), lambda: DocumentRegistry(path), close=DocumentRegistry.close)
+
+
+def chunks_removed(backend, collection, doc_id, chunk_ids=None):
+    '''
+    向量库删除了文档的片段后调用：删除的片段中有检查点记录的片段时重置该文档的登记，
+    以免登记表仍显示已入库，再次提交时什么也不做
+
+    :param chunk_ids: 删除的片段 id，None 表示删除了该文档的全部片段
+    '''
+    if not os.path.exists(registry_path(backend, collection)):
+        return
+    registry = get_registry(backend, collection)
+    if chunk_ids is None or registry.chunk_ids(doc_id) & set(chunk_ids):
+        registry.reset(doc_id)
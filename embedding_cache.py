@@ -0,0 +1,187 @@
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import numpy as np
+
+# SQLite 单条语句的参数个数有上限，批量查询时分段
+_SQL_BATCH = 500
+
+
+def normalize_text(text):
+    '''统一全半角、去掉首尾空白并合并连续空白，作为缓存键的文本部分'''
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', text)).strip()
+
+
+class EmbeddingCache:
+    """
+    基于 SQLite 的持久化向量缓存
+
+    以 (模型, 维度, 归一化文本的哈希) 为键，超出条数或容量上限时按最近访问时间淘汰
+    """
+    def __init__(self, path, max_entries=None, max_bytes=None):
+        """
+        :param path: SQLite 文件路径
+        :param max_entries: 最多缓存的向量条数，None 表示不限
+        :param max_bytes: 向量数据的容量上限（字节），None 表示不限
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key BLOB PRIMARY KEY, vector BLOB NOT NULL, last_access REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON embeddings(last_access)")
+        self._entries, self._bytes = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()
+
+    @staticmethod
+    def make_key(model, dimensions, text):
+        return hashlib.sha256(f"{model}\0{dimensions}\0{normalize_text(text)}".encode('utf-8')).digest()
+
+    def get_many(self, keys):
+        '''批量查询，返回 {key: 向量}，并刷新命中条目的访问时间'''
+        found = {}
+        keys = list(set(keys))
+        with self._lock:
+            for i in range(0, len(keys), _SQL_BATCH):
+                part = keys[i:i + _SQL_BATCH]
+                marks = ','.join('?' * len(part))
+                for key, blob in self._conn.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({marks})", part):
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access=? WHERE key=?", [(now, k) for k in found])
+        return found
+
+    def put_many(self, items):
+        '''批量写入 [(key, 向量), ...]，写入后按上限淘汰'''
+        now = time.time()
+        rows = [(key, np.asarray(vec, dtype=np.float32).tobytes(), now) for key, vec in items]
+        with self._lock:
+            entries, size = self._entries, self._bytes
+            self._conn.execute("BEGIN")
+            try:
+                for key, blob, ts in rows:
+                    old = self._conn.execute("SELECT LENGTH(vector) FROM embeddings WHERE key=?", (key,)).fetchone()
+                    self._conn.execute("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", (key, blob, ts))
+                    if old:
+                        size -= old[0]
+                    else:
+                        entries += 1
+                    size += len(blob)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                # 出错时回滚，不留下未结束的事务，计数也保持写入前的值
+                self._conn.execute("ROLLBACK")
+                raise
+            self._entries, self._bytes = entries, size
+            self._evict()
+
+    def _evict(self):
+        '''淘汰最久未访问的条目，直到回到上限的 90% 以下'''
+        over_entries = self.max_entries is not None and self._entries > self.max_entries
+        over_bytes = self.max_bytes is not None and self._bytes > self.max_bytes
+        if not (over_entries or over_bytes):
+            return
+        target_entries = int(self.max_entries * 0.9) if self.max_entries is not None else self._entries
+        target_bytes = int(self.max_bytes * 0.9) if self.max_bytes is not None else self._bytes
+        victims = []
+        entries, size = self._entries, self._bytes
+        for key, length in self._conn.execute(
+                "SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_access"):
+            if entries <= target_entries and size <= target_bytes:
+                break
+            victims.append((key,))
+            entries -= 1
+            size -= length
+        self._conn.execute("BEGIN")
+        try:
+            self._conn.executemany("DELETE FROM embeddings WHERE key=?", victims)
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._entries, self._bytes = entries, size
+
+    def _missing(self, keys, texts, found):
+        '''未命中的文本，同一批中的重复文本只计算一次'''
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        return missing
+
+    def _assemble(self, keys, found, dimensions):
+        if not keys:
+            return np.empty((0, dimensions or 0), dtype=np.float32)
+        return np.stack([found[k] for k in keys])
+
+    def embed(self, texts, embed_fn, model, dimensions=None):
+        '''
+        先查缓存，只把未命中的文本交给 embed_fn，返回 (len(texts), dim) 的 float32 矩阵
+
+        :param embed_fn: 真正计算嵌入的函数，接收文本列表返回向量矩阵
+        '''
+        texts = list(texts)
+        keys = [self.make_key(model, dimensions, t) for t in texts]
+        found = self.get_many(keys)
+        missing = self._missing(keys, texts, found)
+        if missing:
+            vectors = np.asarray(embed_fn(list(missing.values())), dtype=np.float32)
+            new_items = list(zip(missing.keys(), vectors))
+            self.put_many(new_items)
+            found.update(new_items)
+        return self._assemble(keys, found, dimensions)
+
+    async def aembed(self, texts, embed_fn, model, dimensions=None):
+        '''embed 的 asyncio 版本，embed_fn 为协程函数，SQLite 读写放到线程中执行'''
+        texts = list(texts)
+        keys = [self.make_key(model, dimensions, t) for t in texts]
+        found = await asyncio.to_thread(self.get_many, keys)
+        missing = self._missing(keys, texts, found)
+        if missing:
+            vectors = np.asarray(await embed_fn(list(missing.values())), dtype=np.float32)
+            new_items = list(zip(missing.keys(), vectors))
+            await asyncio.to_thread(self.put_many, new_items)
+            found.update(new_items)
+        return self._assemble(keys, found, dimensions)
+
+    def stats(self):
+        '''缓存命中统计'''
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": self._entries,
+                "bytes": self._bytes,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM embeddings")
+            self._entries = self._bytes = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,175 @@
+import asyncio
+import base64
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import openai
+from openai import AsyncOpenAI, OpenAI
+
+from utils.tokens import count_tokens
+
+# 可以重试的错误：限流、超时、连接失败以及服务端 5xx
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+
+def _retry_after(error):
+    '''从响应头中读取服务端建议的重试等待时间（秒）'''
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    try:
+        if 'retry-after-ms' in response.headers:
+            return float(response.headers['retry-after-ms']) / 1000
+        if 'retry-after' in response.headers:
+            return float(response.headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+
+def _decode(data):
+    '''把 base64 编码的返回结果按 index 排好并解码成 float32 矩阵'''
+    data = sorted(data, key=lambda x: x.index)
+    return np.stack([np.frombuffer(base64.b64decode(x.embedding), dtype=np.float32) for x in data])
+
+
+class BatchEmbeddingClient:
+    """
+    分批并发调用 OpenAI Embedding 接口
+
+    按 token 预算把输入打包成若干批，用有界线程池并发请求，遇到限流时指数退避重试，
+    结果按输入顺序拼成连续的 float32 矩阵
+    """
+    client_class = OpenAI
+
+    def __init__(self, client=None, model="text-embedding-ada-002", dimensions=None,
+                 max_batch_tokens=100000, max_batch_size=2048, max_workers=4,
+                 max_retries=6, backoff=0.5, max_backoff=30.0, **client_kwargs):
+        """
+        :param client: OpenAI 客户端，None 时按 client_kwargs（如 base_url、api_key）新建
+        :param max_batch_tokens: 每个请求的 token 上限
+        :param max_batch_size: 每个请求的文本条数上限
+        :param max_workers: 并发请求数
+        :param max_retries: 单个批次最多重试次数
+        :param backoff: 首次重试的等待时间（秒），之后每次翻倍
+        """
+        if client is None:
+            client = self.client_class(**client_kwargs)
+        # 重试由本类统一处理，避免与 SDK 内置重试叠加
+        self.client = client.with_options(max_retries=0)
+        self.model = model
+        # text-embedding-ada-002 不支持指定维度
+        self.dimensions = None if model == "text-embedding-ada-002" else dimensions
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def pack_batches(self, texts):
+        '''按 token 预算和条数上限把输入切成连续的批次，返回 [(start, stop), ...]'''
+        batches = []
+        start = tokens = 0
+        for i, text in enumerate(texts):
+            n = count_tokens(text, self.model)
+            if i > start and (tokens + n > self.max_batch_tokens or i - start >= self.max_batch_size):
+                batches.append((start, i))
+                start, tokens = i, 0
+            tokens += n
+        if start < len(texts):
+            batches.append((start, len(texts)))
+        return batches
+
+    def _create(self, texts):
+        # 以 base64 传输向量，直接解码成 float32，省去 JSON 浮点数解析和 Python 列表
+        if self.dimensions:
+            return self.client.embeddings.create(
+                input=texts, model=self.model, dimensions=self.dimensions, encoding_format="base64")
+        return self.client.embeddings.create(input=texts, model=self.model, encoding_format="base64")
+
+    def embed_batch(self, texts):
+        '''请求一个批次，限流或临时错误时指数退避重试'''
+        for attempt in range(self.max_retries + 1):
+            try:
+                return _decode(self._create(texts).data)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self._retry_delay(e, attempt))
+
+    def _retry_delay(self, error, attempt):
+        delay = _retry_after(error)
+        if delay is None:
+            delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+        return delay
+
+    def embed(self, texts):
+        '''获取一组文本的嵌入，返回形状为 (len(texts), dim) 的 float32 矩阵'''
+        texts = list(texts)
+        if not texts:
+            return np.empty((0, self.dimensions or 0), dtype=np.float32)
+        batches = self.pack_batches(texts)
+        if len(batches) == 1 or self.max_workers <= 1:
+            results = [self.embed_batch(texts[a:b]) for a, b in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as pool:
+                results = list(pool.map(lambda batch: self.embed_batch(texts[batch[0]:batch[1]]), batches))
+        if len(results) == 1:
+            return np.ascontiguousarray(results[0])
+        return np.concatenate(results, axis=0)
+
+
+class AsyncBatchEmbeddingClient(BatchEmbeddingClient):
+    """BatchEmbeddingClient 的 asyncio 版本，client 为 AsyncOpenAI，用信号量限制并发请求数"""
+    client_class = AsyncOpenAI
+
+    async def embed_batch(self, texts):
+        '''请求一个批次，限流或临时错误时指数退避重试'''
+        for attempt in range(self.max_retries + 1):
+            try:
+                return _decode((await self._create(texts)).data)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self._retry_delay(e, attempt))
+
+    async def embed(self, texts):
+        '''获取一组文本的嵌入，返回形状为 (len(texts), dim) 的 float32 矩阵'''
+        texts = list(texts)
+        if not texts:
+            return np.empty((0, self.dimensions or 0), dtype=np.float32)
+        semaphore = asyncio.Semaphore(max(self.max_workers, 1))
+
+        async def run(a, b):
+            async with semaphore:
+                return await self.embed_batch(texts[a:b])
+
+        results = await asyncio.gather(*(run(a, b) for a, b in self.pack_batches(texts)))
+        if len(results) == 1:
+            return np.ascontiguousarray(results[0])
+        return np.concatenate(results, axis=0)
+
+
+if "__main__" == __name__:
+    from mock_openai_server import start_mock_server
+    from utils.timer import Timer
+
+    # 对本地模拟接口压测：每个请求 50ms 延迟，每 7 个请求触发一次限流
+    server, base_url = start_mock_server(latency=0.05, rate_limit_every=7)
+    texts = [f"第 {i} 段测试文本，" * 20 for i in range(2000)]
+    serial = BatchEmbeddingClient(base_url=base_url, api_key="mock", max_batch_tokens=8000, max_workers=1)
+    batched = BatchEmbeddingClient(base_url=base_url, api_key="mock", max_batch_tokens=8000, max_workers=8)
+    with Timer("串行"):
+        a = serial.embed(texts)
+    with Timer("并发"):
+        b = batched.embed(texts)
+    print(a.shape, a.dtype, bool(np.allclose(a, b)), f"请求数 {server.embedding_requests}")
+    server.shutdown()
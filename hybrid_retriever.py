@@ -0,0 +1,399 @@
+import math
+import re
+import threading
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+from answer_cache import normalize_query
+from chinese_utils import to_keywords, to_keywords_many
+from conf import elasticsearch_url, keyword_index_max_documents
+from distance import top_k as select_top_k
+from embedding_cache import normalize_text
+from utils.fingerprint import chunk_fingerprint
+from utils.fusion import reciprocal_rank_fusion
+
+
+def keywords(text):
+    '''查询的检索词列表，英文统一小写'''
+    return to_keywords(text.lower()).split()
+
+
+def keywords_many(texts):
+    '''入库时批量分词，配置了多个分词进程（conf.keyword_workers）且文本多时使用多进程'''
+    return [k.split() for k in to_keywords_many([t.lower() for t in texts])]
+
+
+def _results(ids, documents, metadatas, distances):
+    return {'ids': [ids], 'documents': [documents], 'metadatas': [metadatas], 'distances': [distances]}
+
+
+class BM25Index:
+    """进程内的 BM25 倒排索引，一个文档一个索引，distances 为 BM25 得分取负"""
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.lock = threading.RLock()
+        self.ids = []
+        self.documents = []
+        self.metadatas = []
+        self.id_set = set()
+        self._lengths = []
+        # 词 -> ([行号], [词频])
+        self._postings = {}
+        # 查询时按需把倒排表转成数组，写入后作废
+        self._arrays = {}
+        self._norm = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, ids, documents, metadatas):
+        '''分词并写入索引，已存在的片段跳过，返回新增的片段数'''
+        with self.lock:
+            new_chunks = {}
+            for chunk_id, doc, meta in zip(ids, documents, metadatas):
+                if chunk_id not in self.id_set and chunk_id not in new_chunks:
+                    new_chunks[chunk_id] = (doc, meta)
+            if not new_chunks:
+                return 0
+            all_terms = keywords_many([doc for doc, _ in new_chunks.values()])
+            for (chunk_id, (doc, meta)), terms in zip(new_chunks.items(), all_terms):
+                row = len(self.ids)
+                for term, tf in Counter(terms).items():
+                    rows, tfs = self._postings.setdefault(term, ([], []))
+                    rows.append(row)
+                    tfs.append(tf)
+                    self._arrays.pop(term, None)
+                self.ids.append(chunk_id)
+                self.documents.append(doc)
+                self.metadatas.append(meta)
+                self.id_set.add(chunk_id)
+                self._lengths.append(len(terms))
+            self._norm = None
+            return len(new_chunks)
+
+    def _posting(self, term):
+        arrays = self._arrays.get(term)
+        if arrays is None:
+            rows, tfs = self._postings[term]
+            arrays = self._arrays[term] = (np.array(rows, dtype=np.int64), np.array(tfs, dtype=np.float32))
+        return arrays
+
+    def search(self, query, top_k=5):
+        '''按 BM25 得分检索，返回与 chroma 相同格式的结果，只包含至少命中一个词的片段'''
+        with self.lock:
+            n = len(self.ids)
+            if not n:
+                return _results([], [], [], [])
+            if self._norm is None:
+                lengths = np.array(self._lengths, dtype=np.float32)
+                # 长度归一化项 k1 * (1 - b + b * |d| / avgdl)
+                self._norm = self.k1 * (1 - self.b + self.b * lengths / max(lengths.mean(), 1.0))
+            scores = np.zeros(n, dtype=np.float32)
+            for term in set(keywords(query)):
+                if term not in self._postings:
+                    continue
+                rows, tfs = self._posting(term)
+                idf = math.log(1 + (n - len(rows) + 0.5) / (len(rows) + 0.5))
+                scores[rows] += idf * tfs * (self.k1 + 1) / (tfs + self._norm[rows])
+            values, rows = select_top_k(scores, top_k)
+            hits = [(float(v), int(r)) for v, r in zip(values, rows) if v > 0]
+            return _results([self.ids[r] for _, r in hits], [self.documents[r] for _, r in hits],
+                            [self.metadatas[r] for _, r in hits], [-v for v, _ in hits])
+
+    def clear(self):
+        with self.lock:
+            self.__init__(self.k1, self.b)
+
+
+class ElasticsearchKeywordIndex:
+    """
+    Elasticsearch 上的关键词索引，接口与 BM25Index 相同，distances 为 ES 得分取负
+
+    片段先用 to_keywords 分好词再写入，ES 侧只按空格切分，不依赖中文分词插件。
+    同一 collection 的所有文档共用一个 ES 索引，按 doc_id 过滤。
+    """
+    def __init__(self, index_name, doc_id=None, hosts=None, client=None):
+        """
+        :param index_name: ES 索引名，只能是小写
+        :param hosts: ES 地址，默认为 conf.elasticsearch_url
+        :param client: 已创建的 Elasticsearch 客户端，提供时忽略 hosts
+        """
+        if client is None:
+            from elasticsearch import Elasticsearch
+            client = Elasticsearch(hosts or elasticsearch_url)
+        self.client = client
+        self.index_name = index_name
+        self.doc_id = doc_id
+        if not client.indices.exists(index=index_name):
+            client.indices.create(index=index_name, ignore=400, body={"mappings": {"properties": {
+                "keywords": {"type": "text", "analyzer": "whitespace"},
+                "document": {"type": "text", "index": False},
+                "doc_id": {"type": "keyword"},
+                "metadata": {"type": "object", "enabled": False},
+            }}})
+
+    def _filter(self):
+        return [{"term": {"doc_id": self.doc_id}}] if self.doc_id is not None else []
+
+    def add(self, ids, documents, metadatas):
+        '''分词并批量写入，以片段 id 作为 ES 文档 id，重复写入会覆盖，返回写入的片段数'''
+        from elasticsearch import helpers
+        actions = [{
+            "_index": self.index_name,
+            "_id": chunk_id,
+            "_source": {"keywords": ' '.join(terms), "document": doc,
+                        "doc_id": self.doc_id, "metadata": meta},
+        } for chunk_id, doc, meta, terms in zip(ids, documents, metadatas, keywords_many(documents))]
+        if not actions:
+            return 0
+        success, _ = helpers.bulk(self.client, actions, refresh="wait_for")
+        return success
+
+    def search(self, query, top_k=5):
+        '''按 ES 的 BM25 得分检索，返回与 chroma 相同格式的结果'''
+        body = {"size": top_k, "query": {"bool": {
+            "must": {"match": {"keywords": ' '.join(keywords(query))}},
+            "filter": self._filter(),
+        }}}
+        hits = self.client.search(index=self.index_name, body=body)["hits"]["hits"]
+        return _results([h["_id"] for h in hits], [h["_source"]["document"] for h in hits],
+                        [h["_source"]["metadata"] for h in hits], [-h["_score"] for h in hits])
+
+    def clear(self):
+        # 不限定文档时的过滤条件为空，会删除整个 collection 的片段
+        if self.doc_id is None:
+            raise ValueError("clear 需要索引限定在一个文档内")
+        self.client.delete_by_query(index=self.index_name, refresh=True,
+                                    body={"query": {"bool": {"filter": self._filter()}}})
+
+
+# 进程内的关键词索引，同一 (collection, 文档) 只建一次，按最近使用淘汰
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def get_keyword_index(collection_name, doc_id=None, vector_db=None):
+    '''
+    配置了 elasticsearch_url 时返回 ES 索引，否则返回进程内的 BM25 索引
+
+    :param vector_db: 文档所在的向量库连接器。进程内的 BM25 索引不落盘，重启后或文档由批量导入工具入库时为空，
+                      提供时在第一次创建索引时从向量库读出该文档的全部片段建立索引，建好之前的检索会等待
+    '''
+    load = False
+    with _indexes_lock:
+        key = (collection_name, doc_id)
+        index = _indexes.get(key)
+        if index is not None:
+            _indexes.move_to_end(key)
+        else:
+            if elasticsearch_url:
+                index = ElasticsearchKeywordIndex(collection_name, doc_id)
+            else:
+                index = BM25Index()
+                load = doc_id is not None and hasattr(vector_db, 'get_documents')
+                if load:
+                    index.lock.acquire()
+            _indexes[key] = index
+            # 被淘汰的索引仍在使用时不受影响，只是下次打开该文档时重建
+            while len(_indexes) > keyword_index_max_documents:
+                _indexes.popitem(last=False)
+    if load:
+        try:
+            chunks = vector_db.get_documents()
+            index.add(chunks['ids'], chunks['documents'], chunks['metadatas'])
+        except BaseException:
+            # 读取失败时不留下空索引，下次调用重新加载
+            with _indexes_lock:
+                _indexes.pop(key, None)
+            raise
+        finally:
+            index.lock.release()
+    return index
+
+
+# 标识符类的查询：不含空白的 ASCII 串，如型号、函数名、版本号
+_IDENTIFIER = re.compile(r'[A-Za-z0-9_][\w.:/#+-]*')
+# 除首字母外还需含数字、符号或大写字母，普通英文单词仍走混合检索
+_IDENTIFIER_MARK = re.compile(r'[\d_.:/#+-]|.[A-Z]')
+
+
+def is_identifier(query):
+    '''查询是否像型号、函数名这样的标识符，这类查询在关键词结果中原样出现即可认定命中'''
+    query = query.strip()
+    return bool(_IDENTIFIER.fullmatch(query) and _IDENTIFIER_MARK.search(query))
+
+
+class HybridRetriever:
+    """
+    关键词 + 向量的混合检索，接口与向量库连接器一致，可以直接交给 RAG_Bot
+
+    两路各取 top_k * candidate_factor 个候选，用加权 RRF 合并。
+    标识符类的查询（如型号、函数名）原样出现在得分最高的关键词候选中时，只用关键词结果，不再调用 Embedding 接口。
+
+    默认参数在 __main__ 的基准上调过：候选只有 top_k * candidate_factor 个，k=60 时名次差异被抹平，
+    混合检索的召回率反而低于 BM25，k=5 且关键词一路权重为 2 时高于任一单路。
+    """
+    def __init__(self, vector_db, keyword_index, candidate_factor=4, exact_max_chars=16, rrf_k=5,
+                 keyword_weight=2.0):
+        """
+        :param vector_db: 向量库连接器
+        :param keyword_index: BM25Index 或 ElasticsearchKeywordIndex
+        :param candidate_factor: 每路候选数相对 top_k 的倍数
+        :param exact_max_chars: 可以只走关键词检索的查询最大长度
+        :param rrf_k: RRF 平滑常数
+        :param keyword_weight: 融合时关键词一路相对向量一路的权重
+        """
+        self.vector_db = vector_db
+        self.keyword_index = keyword_index
+        self.candidate_factor = candidate_factor
+        self.exact_max_chars = exact_max_chars
+        self.rrf_k = rrf_k
+        self.keyword_weight = keyword_weight
+        self.embedding_fn = vector_db.embedding_fn
+        self.doc_id = getattr(vector_db, 'doc_id', None)
+        self.exact_shortcuts = 0
+
+    def add_documents(self, documents, metadatas=None):
+        """写入向量库并建立关键词索引，返回向量库新写入的片段数"""
+        if metadatas is None:
+            metadatas = [{} for _ in documents]
+        added = self.vector_db.add_documents(documents, metadatas)
+        ids = [chunk_fingerprint(self.doc_id, doc) for doc in documents]
+        if self.doc_id is not None:
+            metadatas = [dict(meta, doc_id=self.doc_id) for meta in metadatas]
+        self.keyword_index.add(ids, documents, metadatas)
+        return added
+
+    def count_documents(self):
+        return self.vector_db.count_documents()
+
+    def _exact_hits(self, query, results, top_k):
+        '''标识符类的查询原样出现在得分最高的关键词候选中时，只用关键词结果（原样出现的排在前面），否则返回 None'''
+        term = normalize_query(query)
+        documents = results['documents'][0]
+        if not term or len(term) > self.exact_max_chars or not documents or not is_identifier(query):
+            return None
+        literal = [term in normalize_text(doc).lower() for doc in documents]
+        if not literal[0]:
+            return None
+        rows = sorted(range(len(documents)), key=lambda i: not literal[i])[:top_k]
+        return {key: [[values[0][i] for i in rows]] for key, values in results.items()}
+
+    def keyword_search(self, query, top_k=5):
+        """
+        只做关键词一路的检索，不调用 Embedding 接口
+
+        :return: (精确命中时的结果，否则为 None, 关键词候选)，候选可以交给 search 复用
+        """
+        keyword_results = self.keyword_index.search(query, top_k * self.candidate_factor)
+        exact = self._exact_hits(query, keyword_results, top_k)
+        if exact is not None:
+            self.exact_shortcuts += 1
+        return exact, keyword_results
+
+    def search(self, query, top_k=5, embedding=None, keyword_results=None):
+        """
+        混合检索，返回与 chroma 相同格式的结果，distances 为 1 - RRF 得分
+
+        :param embedding: 已算好的查询向量，提供时不再调用 embedding_fn
+        :param keyword_results: keyword_search 已取得的关键词候选，提供时不再检索关键词索引，也不再判断精确命中
+        """
+        n_candidates = top_k * self.candidate_factor
+        if keyword_results is None:
+            exact, keyword_results = self.keyword_search(query, top_k)
+            if exact is not None:
+                return exact
+        vector_results = self.vector_db.search(query, n_candidates, embedding=embedding)
+        return reciprocal_rank_fusion([vector_results, keyword_results], top_n=top_k, k=self.rrf_k,
+                                      weights=[1.0, self.keyword_weight])
+
+    def search_by_embedding(self, embedding, top_k=5):
+        """只有查询向量时只能做向量检索"""
+        return self.vector_db.search_by_embedding(embedding, top_k)
+
+    def drop_document(self, doc_id=None):
+        """删除文档的向量和关键词索引"""
+        doc_id = doc_id or self.doc_id
+        if doc_id is None:
+            raise ValueError("drop_document 需要指定 doc_id")
+        self.vector_db.drop_document(doc_id)
+        if doc_id == self.doc_id:
+            self.keyword_index.clear()
+
+
+if "__main__" == __name__:
+    import argparse
+    import random
+    import tempfile
+    import time
+    import zlib
+
+    from NumpyVectorDB import NumpyVectorDBConnector
+
+    parser = argparse.ArgumentParser(description="混合检索的召回率与延迟")
+    parser.add_argument("pdf", nargs="?", help="中文 PDF 文件，不指定时使用生成的语料")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--openai", action="store_true", help="使用 OpenAI Embedding，默认用字二元组哈希向量")
+    args = parser.parse_args()
+
+    if args.pdf:
+        from chunker import chunk_pdf
+        corpus = [c.text for c in chunk_pdf(args.pdf, min_line_length=10)]
+    else:
+        topics = ["向量数据库", "检索增强生成", "大语言模型", "中文分词", "倒排索引", "余弦相似度",
+                  "知识图谱", "文本嵌入", "提示词工程", "模型微调", "推理加速", "语义检索"]
+        verbs = ["提高了", "降低了", "改变了", "依赖于", "决定了", "影响了"]
+        objects = ["查询的召回率", "系统的响应延迟", "回答的准确性", "索引的构建速度", "内存的占用", "服务的吞吐量"]
+        rng = random.Random(0)
+        corpus = []
+        for i in range(3000):
+            sentences = [f"{rng.choice(topics)}{rng.choice(verbs)}{rng.choice(objects)}。" for _ in range(4)]
+            sentences.insert(rng.randrange(5), f"型号 QX{i:04d} 的参数记录在第 {i} 节。")
+            corpus.append(''.join(sentences))
+    corpus = list(dict.fromkeys(corpus))
+
+    if args.openai:
+        from mybase import get_embeddings as embedding_fn
+    else:
+        def embedding_fn(texts, dim=1024):
+            '''字二元组哈希成的词袋向量，离线测试时代替语义向量'''
+            out = np.zeros((len(texts), dim), dtype=np.float32)
+            for i, text in enumerate(texts):
+                for a, b in zip(text, text[1:]):
+                    out[i, zlib.crc32((a + b).encode('utf-8')) % dim] += 1
+            return out
+
+    # 每个查询对应一个已知片段：一半是片段中独有的词（精确词查询），一半是片段中间的一段原文
+    rng = random.Random(1)
+    queries = []
+    doc_terms = [Counter(terms) for terms in keywords_many(corpus)]
+    df = Counter(t for terms in doc_terms for t in terms)
+    for i in rng.sample(range(len(corpus)), min(args.queries, len(corpus))):
+        rare = [t for t in doc_terms[i] if df[t] == 1 and len(t) > 1]
+        if rare and len(queries) % 2 == 0:
+            queries.append((rng.choice(rare), i))
+        else:
+            doc = corpus[i]
+            start = rng.randrange(max(len(doc) - 20, 1))
+            queries.append((doc[start:start + 20], i))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        vector_db = NumpyVectorDBConnector("bench", embedding_fn, doc_id="bench", path=tmp)
+        keyword_index = BM25Index()
+        hybrid = HybridRetriever(vector_db, keyword_index)
+        start = time.perf_counter()
+        hybrid.add_documents(corpus)
+        print(f"索引 {len(corpus)} 个片段耗时 {(time.perf_counter() - start) * 1000:.1f} ms")
+        expected = {i: chunk_fingerprint("bench", doc) for i, doc in enumerate(corpus)}
+
+        for name, search in (("向量", vector_db.search), ("BM25", keyword_index.search), ("混合", hybrid.search)):
+            hit = 0
+            start = time.perf_counter()
+            for query, i in queries:
+                hit += expected[i] in search(query, args.top_k)['ids'][0]
+            elapsed = (time.perf_counter() - start) * 1000 / len(queries)
+            print(f"{name}: recall@{args.top_k} = {hit / len(queries):.3f}, 平均延迟 {elapsed:.2f} ms")
+        print(f"混合检索中跳过 Embedding 的查询: {hybrid.exact_shortcuts}/{len(queries)}")
@@ -0,0 +1,247 @@
+"""
+批量建立索引的命令行工具，不经过 streamlit 界面，适合夜间预先导入大量 PDF
+
+提取和切片在进程池中进行，向量计算的并发数有上限，每批页的片段一次性写入向量库。
+每批页完成后在文档登记表中提交检查点，--resume 时跳过已入库的文档和已完成的页：
+    python index_cli.py ./pdfs --jobs 8 --resume
+"""
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from chinese_utils import set_keyword_workers
+from chunker import chunk_pdf
+from conf import collection_name, elasticsearch_url, ingest_page_batch_size, local_vector_db_path, vector_backend
+from doc_registry import FAILED, INDEXED, INDEXING, get_registry
+from pdf_extractor import PageSet, count_pages
+from utils.fingerprint import chunk_fingerprint
+
+
+def iter_pdfs(root):
+    '''按路径顺序遍历目录下的全部 PDF，root 本身是文件时只返回它'''
+    if os.path.isfile(root):
+        yield root
+        return
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.lower().endswith('.pdf'):
+                yield os.path.join(dirpath, name)
+
+
+def _extract(path, pages, min_line_length):
+    '''在子进程中提取并切片一批页，返回 (片段列表, 耗时)'''
+    start = time.perf_counter()
+    chunks = list(chunk_pdf(path, pages, min_line_length=min_line_length, workers=1))
+    return chunks, time.perf_counter() - start
+
+
+class Throughput:
+    """各阶段的处理量和耗时，线程安全"""
+    def __init__(self):
+        self.counts = {}
+        self.seconds = {}
+        self._lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    def add(self, stage, count, seconds=0.0):
+        with self._lock:
+            self.counts[stage] = self.counts.get(stage, 0) + count
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def report(self):
+        '''每个阶段的总量、按总耗时计算的速率和该阶段累计的工作时间'''
+        elapsed = time.perf_counter() - self.start
+        with self._lock:
+            return {stage: {"count": count, "per_second": count / elapsed if elapsed else 0.0,
+                            "busy_seconds": self.seconds[stage]}
+                    for stage, count in self.counts.items()}, elapsed
+
+
+class _Document:
+    """一个文档在本次运行中的进度"""
+    def __init__(self, path, doc_id, num_pages, batches):
+        self.path = path
+        self.doc_id = doc_id
+        self.num_pages = num_pages
+        self.remaining = batches
+        self.error = None
+
+
+class BatchIndexer:
+    """
+    批量入库：进程池提取切片，线程池计算向量并批量写入
+
+    :param store_factory: 根据 doc_id 创建向量库连接器（或 HybridRetriever）的函数
+    :param registry: 写入的向量库对应的登记表（doc_registry.get_registry(backend)），默认为 conf.vector_backend 的登记表
+    :param jobs: 提取切片的进程数
+    :param embed_workers: 同时计算向量并写入的批数
+    :param resume: 为 True 时跳过已入库的文档，未完成的文档从检查点继续
+    """
+    def __init__(self, store_factory, registry=None, jobs=None, embed_workers=4,
+                 page_batch_size=ingest_page_batch_size, min_line_length=10, resume=False):
+        self.store_factory = store_factory
+        self.registry = registry or get_registry()
+        self.jobs = jobs or os.cpu_count() or 1
+        self.embed_workers = embed_workers
+        self.page_batch_size = page_batch_size
+        self.min_line_length = min_line_length
+        self.resume = resume
+        self.throughput = Throughput()
+        self.skipped = []
+        self.failed = {}
+        self.indexed = []
+
+    def _plan(self, path):
+        '''登记文档并算出要处理的页，返回 _Document 和页批次，不需要处理时返回 (None, [])'''
+        doc_id = self.registry.register(path)
+        state = self.registry.get(doc_id)
+        if self.resume and state.indexed:
+            self.skipped.append(path)
+            return None, []
+        num_pages = count_pages(path)
+        pending = PageSet(num_pages)
+        if self.resume:
+            pending = pending.difference(self.registry.pages_done(doc_id, num_pages))
+        pages = list(pending)
+        batches = [pages[i:i + self.page_batch_size] for i in range(0, len(pages), self.page_batch_size)]
+        self.registry.update(doc_id, status=INDEXING, num_pages=num_pages, error=None)
+        return _Document(path, doc_id, num_pages, len(batches)), batches
+
+    def _store(self, doc, pages, chunks):
+        '''计算一批片段的向量并一次性写入，然后提交检查点'''
+        texts = [c.text for c in chunks]
+        store = self.store_factory(doc.doc_id)
+        if texts:
+            start = time.perf_counter()
+            # 先批量计算向量（写入向量缓存），写入向量库时直接命中缓存
+            store.embedding_fn(texts)
+            self.throughput.add("embed", len(texts), time.perf_counter() - start)
+            start = time.perf_counter()
+            store.add_documents(texts, [c.metadata() for c in chunks])
+            self.throughput.add("store", len(texts), time.perf_counter() - start)
+        stored = [(chunk_fingerprint(doc.doc_id, c.text), c.page) for c in chunks]
+        self.registry.checkpoint(doc.doc_id, pages, stored, num_pages=doc.num_pages)
+
+    def _finish(self, doc):
+        if doc.error is not None:
+            self.registry.update(doc.doc_id, status=FAILED, error=doc.error)
+            self.failed[doc.path] = doc.error
+            return
+        chunks = len(self.registry.chunk_ids(doc.doc_id))
+        complete = len(self.registry.pages_done(doc.doc_id, doc.num_pages)) == doc.num_pages
+        self.registry.update(doc.doc_id, status=INDEXED if complete else INDEXING, pages_extracted=doc.num_pages,
+                             chunks=chunks, chunks_embedded=chunks, chunks_stored=chunks)
+        self.indexed.append(doc.path)
+
+    def _batch_done(self, doc, error=None):
+        if error is not None and doc.error is None:
+            doc.error = f"{type(error).__name__}: {error}"
+        doc.remaining -= 1
+        if doc.remaining == 0:
+            self._finish(doc)
+
+    def run(self, paths):
+        '''处理全部文档，返回 throughput.report() 的结果'''
+        max_extracting = self.jobs * 2
+        max_storing = self.embed_workers * 2
+        extracting = {}
+        storing = {}
+        with ProcessPoolExecutor(max_workers=self.jobs) as pool, \
+                ThreadPoolExecutor(max_workers=self.embed_workers) as embed_pool:
+
+            def drain(limit_extracting, limit_storing):
+                # 在途任务超过上限时等待，提取和写入两边都不会无限堆积
+                while len(extracting) > limit_extracting or len(storing) > limit_storing:
+                    done, _ = wait(list(extracting) + list(storing), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        if future in extracting:
+                            doc, pages = extracting.pop(future)
+                            try:
+                                chunks, seconds = future.result()
+                            except Exception as e:
+                                self._batch_done(doc, e)
+                                continue
+                            self.throughput.add("pages", len(pages), seconds)
+                            self.throughput.add("chunks", len(chunks), seconds)
+                            storing[embed_pool.submit(self._store, doc, pages, chunks)] = doc
+                        else:
+                            doc = storing.pop(future)
+                            error = future.exception()
+                            self._batch_done(doc, error)
+
+            for path in paths:
+                try:
+                    doc, batches = self._plan(path)
+                except Exception as e:
+                    self.failed[path] = f"{type(e).__name__}: {e}"
+                    continue
+                if doc is None:
+                    continue
+                if not batches:
+                    self._finish(doc)
+                    continue
+                for pages in batches:
+                    drain(max_extracting - 1, max_storing)
+                    extracting[pool.submit(_extract, path, pages, self.min_line_length)] = (doc, pages)
+            drain(0, 0)
+        return self.throughput.report()
+
+
+def make_store_factory(store, path=local_vector_db_path):
+    '''
+    按 --store 创建向量库连接器；配置了 Elasticsearch 时同时写入关键词索引
+
+    未配置时只写入向量库：进程内的 BM25 索引随进程退出而丢失，网页端第一次打开文档时
+    由 hybrid_retriever.get_keyword_index 从向量库读出片段重建，入库完成的文档同样有关键词检索
+    '''
+    from mybase import get_embeddings
+    from VectorDB import make_vector_db
+
+    def factory(doc_id):
+        vector_db = make_vector_db(collection_name, get_embeddings, doc_id=doc_id, backend=store, path=path)
+        if not elasticsearch_url:
+            return vector_db
+        from hybrid_retriever import HybridRetriever, get_keyword_index
+        return HybridRetriever(vector_db, get_keyword_index(collection_name, doc_id))
+    return factory
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批量为目录下的 PDF 建立索引")
+    parser.add_argument("root", help="PDF 文件或目录，目录会递归遍历")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="提取切片的进程数")
+    parser.add_argument("--embed-workers", type=int, default=4, help="同时计算向量并写入的批数")
+    parser.add_argument("--keyword-workers", type=int, default=os.cpu_count() or 1,
+                        help="写入 Elasticsearch 关键词索引时批量分词的进程数")
+    parser.add_argument("--resume", action="store_true", help="跳过已入库的文档，未完成的文档从检查点继续")
+    parser.add_argument("--page-batch", type=int, default=ingest_page_batch_size, help="每个检查点包含的页数")
+    parser.add_argument("--store", choices=("chroma", "numpy", "faiss"), default=vector_backend,
+                        help="写入的向量库，默认为 conf.vector_backend，与网页端一致")
+    args = parser.parse_args(argv)
+    set_keyword_workers(args.keyword_workers)
+
+    # 每个向量库各有一份登记表，--resume 只信任写入同一向量库的检查点
+    indexer = BatchIndexer(make_store_factory(args.store), registry=get_registry(args.store),
+                           jobs=args.jobs, embed_workers=args.embed_workers,
+                           page_batch_size=args.page_batch, resume=args.resume)
+    report, elapsed = indexer.run(iter_pdfs(args.root))
+
+    names = {"pages": "提取页数", "chunks": "切片数", "embed": "向量数", "store": "写入片段数"}
+    units = {"pages": "页/秒", "chunks": "段/秒", "embed": "条/秒", "store": "段/秒"}
+    print(f"完成 {len(indexer.indexed)} 个文档，跳过 {len(indexer.skipped)} 个，失败 {len(indexer.failed)} 个，"
+          f"总耗时 {elapsed:.1f} s")
+    for stage in ("pages", "chunks", "embed", "store"):
+        row = report.get(stage)
+        if row is not None:
+            print(f"  {names[stage]:<8}{row['count']:>10}  {row['per_second']:>10.1f} {units[stage]}"
+                  f"  累计工作 {row['busy_seconds']:.1f} s")
+    for path, error in indexer.failed.items():
+        print(f"  失败: {path}: {error}")
+    return 1 if indexer.failed else 0
+
+
+if "__main__" == __name__:
+    raise SystemExit(main())
@@ -0,0 +1,280 @@
+import multiprocessing
+import queue
+import threading
+import time
+
+from chunker import chunk_pdf
+from conf import ingest_batch_size, ingest_extract_workers, ingest_page_batch_size, ingest_pages_per_task, \
+    ingest_workers
+from doc_registry import FAILED, INDEXED, INDEXING, PENDING
+from pdf_extractor import PageSet, count_pages
+from utils.fingerprint import chunk_fingerprint, file_fingerprint
+
+
+class IngestJob:
+    """一个 PDF 的入库任务，记录各阶段的进度"""
+    def __init__(self, doc_id, data, name=None, page_numbers=None):
+        self.doc_id = doc_id
+        self.name = name
+        self.data = data
+        self.page_numbers = page_numbers
+        self.status = "queued"  # queued / running / done / failed
+        self.error = None
+        self.num_pages = 0
+        self.pages_total = 0
+        self.pages_parsed = 0
+        self.chunks_embedded = 0
+        self.chunks_stored = 0
+        self.chunks_added = 0
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._changed = threading.Condition()
+
+    @property
+    def done(self):
+        return self.status == "done"
+
+    def _update(self, **kwargs):
+        with self._changed:
+            for key, value in kwargs.items():
+                setattr(self, key, value)
+            self._changed.notify_all()
+
+    def wait(self, predicate=None, timeout=None):
+        '''等到 predicate(job) 为真或任务结束，predicate 为 None 时等到任务结束，返回 predicate 的结果'''
+        predicate = predicate or (lambda job: False)
+        with self._changed:
+            self._changed.wait_for(lambda: predicate(self) or self.status in ("done", "failed"), timeout)
+            return predicate(self)
+
+    def progress(self):
+        '''进度快照，用于界面展示'''
+        end = self.finished or time.time()
+        return {
+            "status": self.status,
+            "error": self.error,
+            "pages_total": self.pages_total,
+            "pages_parsed": self.pages_parsed,
+            "chunks_embedded": self.chunks_embedded,
+            "chunks_stored": self.chunks_stored,
+            "chunks_added": self.chunks_added,
+            "elapsed": end - self.started if self.started else 0.0,
+        }
+
+
+class IngestWorker:
+    """
+    后台入库：任务队列加若干工作线程，上传后立即开始解析、计算向量和写入
+
+    每批片段写入后即可被检索，入库过程中提问可以基于已写入的片段回答。
+    同一文档只入库一次，失败的任务再次提交时重新入库。提供文档登记表时进度同步记录到登记表，
+    登记表中已入库（且向量库中有检查点记录的片段）的文档直接视为完成，重启后也不会重新入库。
+
+    待处理的页作为一个片段流在进程池中提取（每个任务 pages_per_task 页），片段的起始页越过一批页时，
+    这批页的片段已全部写入，在登记表中提交检查点（完成的页和写入的片段 id），
+    中途失败或进程重启后再次提交时从检查点继续，只处理还没有完成的页。
+    """
+    def __init__(self, vector_db_factory, max_workers=ingest_workers, batch_size=ingest_batch_size,
+                 on_batch_stored=None, registry=None, page_batch_size=ingest_page_batch_size,
+                 extract_workers=ingest_extract_workers, pages_per_task=ingest_pages_per_task):
+        """
+        :param vector_db_factory: 根据 doc_id 创建向量库连接器的函数
+        :param max_workers: 工作线程数
+        :param batch_size: 每批计算向量并写入的片段数
+        :param page_batch_size: 每个检查点包含的页数
+        :param on_batch_stored: 每批写入新片段后的回调，参数为 (doc_id, 新写入的片段数)
+        :param registry: 文档登记表（doc_registry.DocumentRegistry）
+        :param extract_workers: 每个任务提取文字的进程数，1 表示在工作线程中提取
+        :param pages_per_task: 每个提取任务的页数，应小于 page_batch_size，第一批片段不必等一整批页
+        """
+        self.vector_db_factory = vector_db_factory
+        self.batch_size = batch_size
+        self.on_batch_stored = on_batch_stored
+        self.registry = registry
+        self.page_batch_size = page_batch_size
+        self.extract_workers = extract_workers
+        self.pages_per_task = pages_per_task
+        self._queue = queue.Queue()
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._run, daemon=True, name=f"ingest-{i}")
+                         for i in range(max_workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, source, doc_id=None, name=None, page_numbers=None, retry_failed=True):
+        '''
+        提交入库任务，返回 IngestJob；该文档已在队列中、正在入库或已完成时直接返回已有任务
+
+        :param source: PDF 的 bytes、文件路径或文件对象
+        :param page_numbers: 要入库的页码，None 表示全部页；之后再提交更多页时只处理新增的页
+        :param retry_failed: 该文档上次入库失败时是否重新入库，为 False 时返回失败的任务以便显示错误
+        '''
+        if self.registry is not None:
+            doc_id = self.registry.register(source, name, doc_id)
+        doc_id = doc_id or file_fingerprint(source)
+        with self._lock:
+            job = self._jobs.get(doc_id)
+            if self._reusable(job, page_numbers, retry_failed):
+                return job
+        indexed = self._indexed_job(doc_id, name)
+        with self._lock:
+            job = self._jobs.get(doc_id)
+            if self._reusable(job, page_numbers, retry_failed):
+                return job
+            if indexed is not None:
+                self._jobs[doc_id] = indexed
+                return indexed
+            data = source.getvalue() if hasattr(source, 'getvalue') else source
+            job = self._jobs[doc_id] = IngestJob(doc_id, data, name, page_numbers)
+        self._queue.put(job)
+        return job
+
+    def _reusable(self, job, page_numbers, retry_failed=True):
+        '''
+        已有任务能否代替新提交的任务：未失败（或不重试失败的任务），且已完成的任务处理过全部页（或同样的页）
+
+        已完成的任务还要求登记表中这些页仍然完成，向量库删除了文档的片段（登记被重置）后重新入库
+        '''
+        if job is None:
+            return False
+        if job.status == "failed":
+            return not retry_failed
+        if not job.done:
+            return True
+        if job.page_numbers is not None and job.page_numbers != page_numbers:
+            return False
+        if self.registry is None:
+            return True
+        wanted = PageSet(job.num_pages, job.page_numbers)
+        return not wanted.difference(self.registry.pages_done(job.doc_id, job.num_pages))
+
+    def _indexed_job(self, doc_id, name):
+        '''登记表中已入库、且向量库中有检查点记录的全部片段的文档，返回已完成的任务，否则返回 None'''
+        if self.registry is None:
+            return None
+        state = self.registry.get(doc_id)
+        if state is None or not state.indexed:
+            return None
+        stored = self.vector_db_factory(doc_id).count_documents()
+        if not stored or stored < len(self.registry.chunk_ids(doc_id)):
+            return None
+        job = IngestJob(doc_id, None, name or state.name)
+        job.status = "done"
+        job.num_pages = job.pages_total = job.pages_parsed = state.num_pages
+        job.chunks_embedded = state.chunks_embedded
+        job.chunks_stored = state.chunks_stored
+        job.started = job.finished = state.updated
+        return job
+
+    def get(self, doc_id):
+        with self._lock:
+            return self._jobs.get(doc_id)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._ingest(job)
+            except Exception as e:
+                self._record(job, FAILED, error=str(e))
+                job._update(status="failed", error=str(e), finished=time.time())
+            finally:
+                job.data = None
+                self._queue.task_done()
+
+    def _progress_fields(self, job, status):
+        return dict(status=status, num_pages=job.num_pages, pages_extracted=job.pages_parsed,
+                    chunks=job.chunks_stored, chunks_embedded=job.chunks_embedded, chunks_stored=job.chunks_stored)
+
+    def _record(self, job, status, **fields):
+        '''把任务进度写入文档登记表'''
+        if self.registry is not None:
+            self.registry.update(job.doc_id, **self._progress_fields(job, status), **fields)
+
+    def _checkpoint(self, job, pages, chunks):
+        '''一批页完成后提交检查点'''
+        job._update(pages_parsed=job.pages_parsed + len(pages))
+        if self.registry is not None:
+            stored = [(chunk_fingerprint(job.doc_id, c.text), c.page) for c in chunks]
+            self.registry.checkpoint(job.doc_id, pages, stored, **self._progress_fields(job, INDEXING))
+
+    def _store(self, job, vector_db, chunks, known):
+        '''
+        计算一批片段的向量并写入向量库
+
+        :param known: 已计入进度的片段 id，从检查点继续时重做的片段不重复计数
+        '''
+        texts = [c.text for c in chunks]
+        new_ids = {chunk_fingerprint(job.doc_id, t) for t in texts} - known
+        known.update(new_ids)
+        # 先计算向量（写入向量缓存），再写入向量库，两个阶段分别计数
+        vector_db.embedding_fn(texts)
+        job._update(chunks_embedded=job.chunks_embedded + len(new_ids))
+        added = vector_db.add_documents(texts, [c.metadata() for c in chunks])
+        job._update(chunks_stored=job.chunks_stored + len(new_ids), chunks_added=job.chunks_added + added)
+        if added and self.on_batch_stored is not None:
+            self.on_batch_stored(job.doc_id, added)
+
+    def _pending_pages(self, job, num_pages, vector_db):
+        '''
+        本次要处理的页：请求的页去掉检查点中已完成的页，同时返回检查点中已写入的片段 id
+
+        向量库中的片段少于检查点记录的（片段被删除、或写入了另一个向量库）时检查点不可信，清空后从头入库
+        '''
+        wanted = PageSet(num_pages, job.page_numbers)
+        if self.registry is None:
+            return wanted, wanted, set()
+        known = self.registry.chunk_ids(job.doc_id)
+        if known and vector_db.count_documents() < len(known):
+            self.registry.reset(job.doc_id)
+            known = set()
+        # 从检查点继续时进度接着检查点中的片段数
+        job.chunks_embedded = job.chunks_stored = len(known)
+        return wanted, wanted.difference(self.registry.pages_done(job.doc_id, num_pages)), known
+
+    def _ingest(self, job):
+        num_pages = count_pages(job.data)
+        vector_db = self.vector_db_factory(job.doc_id)
+        wanted, pending, known = self._pending_pages(job, num_pages, vector_db)
+        job._update(status="running", started=time.time(), num_pages=num_pages, pages_total=len(wanted),
+                    pages_parsed=len(wanted) - len(pending))
+        self._record(job, INDEXING, error=None)
+        pages = list(pending)
+        # 全部待处理的页只解析一次，在进程池中按任务并行提取，片段按页序输出；
+        # 从检查点继续时片段序号接着已写入的片段，context_packer 据此判断片段是否相邻
+        chunks = chunk_pdf(job.data, pending, min_line_length=10, start_index=len(known),
+                           workers=self.extract_workers, pages_per_task=self.pages_per_task,
+                           mp_context=multiprocessing.get_context("spawn"))
+        start = 0
+        unstored, stored = [], []
+        for chunk in chunks:
+            # 片段的起始页越过当前这批页时，起始于这批页的片段都已输出，全部写入后提交检查点；
+            # 跨页的片段归入起始页所在的批次，从检查点继续时后面的页重新切片，内容不会遗漏
+            while start + self.page_batch_size < len(pages) and chunk.page >= pages[start + self.page_batch_size]:
+                if unstored:
+                    self._store(job, vector_db, unstored, known)
+                    stored += unstored
+                    unstored = []
+                self._checkpoint(job, pages[start:start + self.page_batch_size], stored)
+                start += self.page_batch_size
+                stored = []
+            unstored.append(chunk)
+            if len(unstored) >= self.batch_size:
+                self._store(job, vector_db, unstored, known)
+                stored += unstored
+                unstored = []
+        if unstored:
+            self._store(job, vector_db, unstored, known)
+            stored += unstored
+        if start < len(pages):
+            self._checkpoint(job, pages[start:], stored)
+        # 只入库了部分页时保持待处理状态，之后提交全部页时只处理剩下的页
+        if self.registry is None:
+            complete = job.page_numbers is None
+        else:
+            complete = len(self.registry.pages_done(job.doc_id, num_pages)) == num_pages
+        # 先写登记表再通知等待的线程
+        self._record(job, INDEXED if complete else PENDING)
+        job._update(status="done", finished=time.time())
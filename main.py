@@ -1,8 +1,14 @@
+import logging
+
 import streamlit as st
 
-from utils import show_original_pdf
-from ai_interface import get_ai_response
-from conf import container_height
+from utils.load_pdf import show_original_pdf
+from ai_interface import get_ai_response_stream, get_ingest_worker, start_ingest
+from conf import container_height, debug
+from resources import footprint
+
+# RAG_Bot 等模块按请求记录 prompt 用量
+logging.basicConfig(level=logging.INFO)
 
 
 def pdf_preview(uploaded_file):
@@ -15,10 +21,28 @@ def pdf_preview(uploaded_file):
             #     st.warning(f"文件大小为 {file_size:.1f} MB，可能需要等待较长的时间或者无法显示。")
         
         st.session_state.pdf_file = uploaded_file
-        # 读取上传的文件数据
-        bytes_data = uploaded_file.read()
+        # 上传后立即在后台入库，不必等到第一次提问；同一文件只处理一次
+        job = start_ingest(uploaded_file)
+        if job.status == "failed":
+            st.error(f"PDF 入库失败: {job.error}")
+        elif not job.done:
+            # 只在入库进行中渲染轮询进度的片段，入库结束后整页重跑一次，片段不再出现
+            ingest_progress()
+        # 直接使用上传文件的缓冲区，不复制数据
         # 显示PDF文件
-        show_original_pdf(bytes_data, file_size)
+        show_original_pdf(uploaded_file.getbuffer(), file_size, job.doc_id)
+
+@st.fragment(run_every=1)
+def ingest_progress():
+    """显示后台入库进度，入库结束（完成或失败）后重跑整页，停止轮询"""
+    job = get_ingest_worker().get(st.session_state.get('doc_id'))
+    if job is None or job.status in ("done", "failed"):
+        st.rerun()
+    p = job.progress()
+    total = p['pages_total'] or 1
+    st.progress(min(p['pages_parsed'] / total, 1.0),
+                text=f"正在建立索引：已解析 {p['pages_parsed']}/{p['pages_total']} 页，"
+                     f"已计算向量 {p['chunks_embedded']} 段，已写入 {p['chunks_stored']} 段")
 
 def pdf_chat():
     # 初始化聊天历史
@@ -39,17 +63,23 @@ def pdf_chat():
         with messages.chat_message("user"):
             st.markdown(user_input)
         
-        # 使用spinner显示加载动画
-        with st.spinner("AI正在思考中..."):
-            # 获取并显示AI响应
-            response = get_ai_response(user_input)
-            with messages.chat_message("assistant"):
-                st.markdown(response)
+        # 流式显示AI响应，边生成边显示
+        with messages.chat_message("assistant"):
+            response = st.write_stream(get_ai_response_stream(user_input))
 
         # 更新聊天历史
         st.session_state.chat_history.append(f"user: {user_input}")
         st.session_state.chat_history.append(f"assistant: {response}")
 
+def resource_footprint():
+    """管理用：进程内共享资源（模型、客户端、缓存）的内存占用和加载耗时，只在调试模式下显示"""
+    def mb(value):
+        return None if value is None else round(value / 1024 / 1024, 1)
+    with st.sidebar.expander("资源占用"):
+        st.dataframe([{"资源": row['name'], "类型": row['type'], "自身 (MB)": mb(row['bytes']),
+                       "常驻内存增量 (MB)": mb(row['rss_delta']), "加载耗时 (s)": row['load_seconds']}
+                      for row in footprint()], hide_index=True)
+
 if __name__ == "__main__":
     # 设置页面配置
     st.set_page_config(layout="wide", initial_sidebar_state="expanded")
@@ -62,3 +92,6 @@ if __name__ == "__main__":
                 
     with _right:
         pdf_chat()
+
+    if debug:
+        resource_footprint()
@@ -0,0 +1,176 @@
+"""
+本地模拟的 OpenAI 接口，用于在不联网的情况下测试和压测
+
+用法：
+    python mock_openai_server.py --port 8100
+    OPENAI_BASE_URL=http://127.0.0.1:8100/v1 OPENAI_API_KEY=mock streamlit run main.py
+"""
+import base64
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+def fake_embedding(text, dimensions=1536):
+    '''由文本哈希生成确定性的单位向量，相同文本得到相同向量'''
+    seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+    vec = np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+    return vec / np.linalg.norm(vec)
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _rate_limited(self):
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+            count = server.request_count
+        if server.rate_limit_every and count % server.rate_limit_every == 0:
+            self._send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_exceeded"}},
+                            headers={"retry-after-ms": "50"})
+            return True
+        return False
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        if self._rate_limited():
+            return
+        if self.path.endswith("/embeddings"):
+            self._handle_embeddings(payload)
+        elif self.path.endswith("/chat/completions"):
+            self._handle_chat(payload)
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def _handle_embeddings(self, payload):
+        texts = payload["input"]
+        if isinstance(texts, str):
+            texts = [texts]
+        dimensions = payload.get("dimensions") or self.server.dimensions
+        time.sleep(self.server.latency)
+        if payload.get("encoding_format") == "base64":
+            encode = lambda v: base64.b64encode(v.tobytes()).decode('ascii')
+        else:
+            encode = lambda v: v.tolist()
+        data = [{"object": "embedding", "index": i, "embedding": encode(fake_embedding(t, dimensions))}
+                for i, t in enumerate(texts)]
+        tokens = sum(len(t) for t in texts)
+        with self.server.lock:
+            self.server.embedding_requests += 1
+            self.server.embedding_inputs += len(texts)
+        self._send_json(200, {
+            "object": "list",
+            "data": data,
+            "model": payload.get("model", "mock"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+
+    def _handle_chat(self, payload):
+        prompt = payload["messages"][-1]["content"]
+        # 回答内容固定，按两个字符一个 token 输出
+        answer = f"这是模拟回答，问题长度为 {len(prompt)} 个字符。"
+        tokens = [answer[i:i + 2] for i in range(0, len(answer), 2)]
+        model = payload.get("model", "mock")
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.chat_requests += 1
+        if not payload.get("stream"):
+            time.sleep(self.server.token_latency * len(tokens))
+            self._send_json(200, {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": len(prompt), "completion_tokens": len(tokens),
+                          "total_tokens": len(prompt) + len(tokens)},
+            })
+            return
+        # 流式输出（server-sent events），写完后关闭连接
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        for i, token in enumerate(tokens + [None]):
+            chunk = {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": token} if token else {},
+                             "finish_reason": None if token else "stop"}],
+            }
+            if i:
+                time.sleep(self.server.token_latency)
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def start_mock_server(host="127.0.0.1", port=0, latency=0.0, dimensions=1536, rate_limit_every=0,
+                      token_latency=0.0):
+    """
+    在后台线程中启动模拟服务
+
+    :param latency: 每个请求额外的延迟（秒），对话接口即首个 token 的延迟
+    :param dimensions: 默认向量维度
+    :param rate_limit_every: 每 N 个请求返回一次 429，0 表示不限流
+    :param token_latency: 对话接口每个 token 之间的延迟（秒）
+    :return: (server, base_url)，用完后调用 server.shutdown()
+    """
+    server = ThreadingHTTPServer((host, port), MockOpenAIHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.dimensions = dimensions
+    server.rate_limit_every = rate_limit_every
+    server.lock = threading.Lock()
+    server.request_count = 0
+    server.embedding_requests = 0
+    server.embedding_inputs = 0
+    server.token_latency = token_latency
+    server.chat_requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+if "__main__" == __name__:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="本地模拟 OpenAI 接口")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--rate-limit-every", type=int, default=0)
+    parser.add_argument("--token-latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server, base_url = start_mock_server(port=args.port, latency=args.latency,
+                                         rate_limit_every=args.rate_limit_every,
+                                         token_latency=args.token_latency)
+    print(f"模拟服务运行在 {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,26 +1,96 @@
-from openai import OpenAI
+import asyncio
+
+from openai import AsyncOpenAI, OpenAI
 from dotenv import load_dotenv, find_dotenv
-import streamlit as st
+
+from answer_cache import AnswerCache
+from conf import (embedding_cache_path, embedding_cache_max_bytes,
+                  answer_cache_max_entries, answer_cache_ttl, answer_cache_similarity,
+                  embedding_backend, local_embedding_model, openai_embedding_model, openai_embedding_dimensions)
+from embedding_cache import EmbeddingCache
+from embedding_client import AsyncBatchEmbeddingClient, BatchEmbeddingClient
+from local_embedding import get_local_embedder
+from context_packer import pack_context
+from utils.tokens import count_tokens
+from pdf_extractor import iter_paragraphs
+from resources import get_resource
 
 _ = load_dotenv(find_dotenv())
 
-# 调用get_embeddings的时候需要用到client的方法
-client = OpenAI()
+def get_client():
+    '''进程内共享的 OpenAI client，第一次调用时创建'''
+    return get_resource("openai_client", OpenAI, close=OpenAI.close)
+
+def get_async_client():
+    '''异步接口使用的 client，供 AsyncRAGBot 在一个事件循环里并发处理多个问题'''
+    return get_resource("async_openai_client", AsyncOpenAI)
 
+def get_embedding_cache():
+    '''持久化的向量缓存，相同文本不会重复调用 Embedding 接口'''
+    return get_resource("embedding_cache",
+                        lambda: EmbeddingCache(embedding_cache_path, max_bytes=embedding_cache_max_bytes),
+                        close=EmbeddingCache.close)
 
-from pdfminer.high_level import extract_pages
-from pdfminer.layout import LTTextContainer
+def get_answer_cache():
+    '''进程内的问答缓存，同一文档的相同或相近问题直接返回上次的回答'''
+    return get_resource("answer_cache",
+                        lambda: AnswerCache(answer_cache_max_entries, answer_cache_ttl, answer_cache_similarity))
+
+_lazy_resources = {"client": get_client, "async_client": get_async_client,
+                   "embedding_cache": get_embedding_cache, "answer_cache": get_answer_cache}
+
+def __getattr__(name):
+    # 兼容 from mybase import client / answer_cache 等写法，导入 mybase 时不再创建客户端和缓存
+    if name in _lazy_resources:
+        return _lazy_resources[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def get_completion(prompt, model="gpt-3.5-turbo"):
     '''封装 openai 接口'''
     messages = [{"role": "user", "content": prompt}]
-    response = client.chat.completions.create(
+    response = get_client().chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=0,  # 模型输出的随机性，0 表示随机性最小
+    )
+    return response.choices[0].message.content
+
+def get_completion_stream(prompt, model="gpt-3.5-turbo"):
+    '''封装 openai 流式接口，逐段 yield 模型生成的文本'''
+    messages = [{"role": "user", "content": prompt}]
+    stream = get_client().chat.completions.create(
         model=model,
         messages=messages,
         temperature=0,  # 模型输出的随机性，0 表示随机性最小
+        stream=True,
+    )
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+async def aget_completion(prompt, model="gpt-3.5-turbo"):
+    '''get_completion 的异步版本'''
+    messages = [{"role": "user", "content": prompt}]
+    response = await get_async_client().chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=0,
     )
     return response.choices[0].message.content
 
+async def aget_completion_stream(prompt, model="gpt-3.5-turbo"):
+    '''get_completion_stream 的异步版本'''
+    messages = [{"role": "user", "content": prompt}]
+    stream = await get_async_client().chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=0,
+        stream=True,
+    )
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
 def build_prompt(prompt_template, **kwargs):
     '''将 Prompt 模板赋值'''
     inputs = {}
@@ -47,43 +117,46 @@ prompt_template = """
     请用中文回答用户问题。
     """
 
-def get_embeddings(texts, model="text-embedding-ada-002", dimensions=None):
-    '''封装 OpenAI 的 Embedding 模型接口，从给定的文本获取嵌入'''
-    if model == "text-embedding-ada-002":
-        dimensions = None
-    if dimensions:
-        data = client.embeddings.create(
-            input=texts, model=model, dimensions=dimensions).data
-    else:
-        data = client.embeddings.create(input=texts, model=model).data
-    return [x.embedding for x in data]
+def build_rag_prompt(query, documents, metadatas=None, model="gpt-3.5-turbo", max_tokens=None):
+    '''
+    整理检索到的片段（去重、合并相接的片段、按 token 预算截取）后填入 prompt_template
+
+    :return: (prompt, 用量统计)，用量统计包含上下文和整个 prompt 的 token 数
+    '''
+    packed = pack_context(documents, metadatas, model, max_tokens)
+    prompt = build_prompt(prompt_template, context=packed.texts, query=query)
+    usage = {
+        "prompt_tokens": count_tokens(prompt, model),
+        "context_tokens": packed.tokens,
+        "chunks": len(packed.texts),
+        "dropped": packed.dropped,
+        "merged": packed.merged,
+    }
+    return prompt, usage
+
+def get_embeddings(texts, model=openai_embedding_model, dimensions=openai_embedding_dimensions):
+    '''
+    封装 OpenAI 的 Embedding 模型接口，先查向量缓存，未命中的文本分批并发获取嵌入，返回 float32 矩阵
+
+    conf.embedding_backend 为 local 时改用本地模型 conf.local_embedding_model，忽略 model 和 dimensions
+    '''
+    if embedding_backend == "local":
+        embedder = get_local_embedder(local_embedding_model)
+        return get_embedding_cache().embed(texts, embedder.embed, local_embedding_model)
+    embedder = BatchEmbeddingClient(get_client(), model=model, dimensions=dimensions)
+    return get_embedding_cache().embed(texts, embedder.embed, model, embedder.dimensions)
+
+async def aget_embeddings(texts, model=openai_embedding_model, dimensions=openai_embedding_dimensions):
+    '''get_embeddings 的异步版本，与同步版本共用向量缓存'''
+    if embedding_backend == "local":
+        # 本地推理占用 CPU，放到线程中执行，不阻塞事件循环
+        return await asyncio.to_thread(get_embeddings, texts, model, dimensions)
+    embedder = AsyncBatchEmbeddingClient(get_async_client(), model=model, dimensions=dimensions)
+    return await get_embedding_cache().aembed(texts, embedder.embed, model, embedder.dimensions)
     
 def extract_text_from_pdf(filename, page_numbers=None, min_line_length=1):
-    """从 PDF 文件中（按指定页码）提取文字"""
-    paragraphs = []
-    buffer = ''
-    full_text = ''
-    # 提取全部文本
-    for i, page_layout in enumerate(extract_pages(filename)):
-        # 如果指定了页码范围，跳过范围外的页
-        if page_numbers is not None and i not in page_numbers:
-            continue
-        for element in page_layout:
-            if isinstance(element, LTTextContainer):
-                full_text += element.get_text() + '\n'
-    # 按空行分隔，将文本重新组织成段落
-    lines = full_text.split('\n')
-    # 调试
-    st.write(lines)
-    for text in lines:
-        if len(text) >= min_line_length:
-            buffer += (' '+text) if not text.endswith('-') else text.strip('-')
-        elif buffer:
-            paragraphs.append(buffer)
-            buffer = ''
-    if buffer:
-        paragraphs.append(buffer)
-    return paragraphs
+    """从 PDF 文件中（按指定页码）提取文字，段落的页码信息见 pdf_extractor.iter_paragraphs"""
+    return [p.text for p in iter_paragraphs(filename, page_numbers, min_line_length)]
 
 
 # 测试代码
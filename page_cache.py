@@ -0,0 +1,338 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import fitz  # PyMuPDF
+
+from conf import page_cache_dir, page_cache_disk_max_bytes, page_cache_max_bytes, page_cache_max_documents, \
+    page_prefetch
+from resources import get_resource
+from utils.fingerprint import file_fingerprint
+
+
+class _Document:
+    """
+    内存中打开的一个 PDF，PyMuPDF 的文档对象不是线程安全的，渲染时加锁
+
+    refs 为正在使用该文档的渲染数，被淘汰时还有渲染在用则先标记 closing，最后一个渲染结束后再关闭
+    """
+    def __init__(self, data):
+        # 保留数据的引用，fitz 文档在关闭前都会读取这块内存
+        self.data = data
+        self.doc = fitz.open(stream=data, filetype="pdf")
+        self.page_count = len(self.doc)
+        self.lock = threading.Lock()
+        self.refs = 0
+        self.closing = False
+
+    def render(self, page_num, scale):
+        with self.lock:
+            pix = self.doc.load_page(page_num).get_pixmap(matrix=fitz.Matrix(scale, scale), alpha=False)
+            return pix.tobytes("png")
+
+    def close(self):
+        with self.lock:
+            self.doc.close()
+
+
+class PageCache:
+    """
+    PDF 页面渲染缓存，以 (文档指纹, 页码, 缩放比例) 为键
+
+    渲染结果为 PNG 字节，内存和磁盘两级缓存，各自超出容量上限时按最近访问淘汰。
+    页面按需渲染，读取一页后在后台线程预取前后相邻的页。
+    所有会话共用打开的文档，一个会话打开新文档可能淘汰另一个会话正在看的文档：
+    get / page_count 传入 source 时，文档已被淘汰就重新打开。
+    """
+    def __init__(self, max_bytes=page_cache_max_bytes, disk_dir=page_cache_dir,
+                 disk_max_bytes=page_cache_disk_max_bytes, max_documents=page_cache_max_documents,
+                 prefetch=page_prefetch):
+        """
+        :param max_bytes: 内存缓存的容量上限（字节）
+        :param disk_dir: 磁盘缓存目录，None 表示不使用磁盘缓存
+        :param disk_max_bytes: 磁盘缓存的容量上限（字节）
+        :param max_documents: 同时保持打开的文档数，超出时关闭最久未访问的
+        :param prefetch: 预取当前页前后各多少页，0 表示不预取
+        """
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.max_documents = max_documents
+        self.prefetch = prefetch
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._pages = OrderedDict()
+        self._bytes = 0
+        self._docs = OrderedDict()
+        # 页数在文档被淘汰后仍然保留，预取时不必重新打开
+        self._page_counts = {}
+        self._inflight = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="page-prefetch")
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._scan_disk()
+
+    def _scan_disk(self):
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith('.png'):
+                st = os.stat(os.path.join(self.disk_dir, name))
+                entries.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(entries):
+            self._disk[name] = size
+            self._disk_bytes += size
+
+    @staticmethod
+    def _disk_name(key):
+        doc_id, page_num, scale = key
+        return f"{doc_id}_{page_num}_{scale:g}.png"
+
+    def open(self, source, doc_id=None):
+        '''
+        打开 PDF（不写临时文件），返回文档指纹，已打开的文档直接复用
+
+        :param source: PDF 的 bytes/memoryview 或文件对象（如 streamlit 的 UploadedFile）
+        '''
+        doc_id = doc_id or file_fingerprint(source)
+        with self._lock:
+            if doc_id in self._docs:
+                self._docs.move_to_end(doc_id)
+                return doc_id
+        data = source.getvalue() if hasattr(source, 'getvalue') else bytes(source)
+        document = _Document(data)
+        victims = []
+        with self._lock:
+            if doc_id in self._docs:
+                victims.append(document)
+            else:
+                self._docs[doc_id] = document
+                self._page_counts[doc_id] = document.page_count
+                while len(self._docs) > self.max_documents:
+                    victims.append(self._docs.popitem(last=False)[1])
+            self._docs.move_to_end(doc_id)
+        for victim in victims:
+            self._retire(victim)
+        return doc_id
+
+    def page_count(self, doc_id, source=None):
+        '''文档的页数，文档未打开过且提供了 source 时先打开'''
+        with self._lock:
+            count = self._page_counts.get(doc_id)
+        if count is None:
+            document = self._acquire(doc_id, source)
+            self._release(document)
+            count = document.page_count
+        return count
+
+    def _acquire(self, doc_id, source=None):
+        '''取出打开的文档并加引用，使用期间被淘汰也不会关闭；文档未打开时用 source 重新打开'''
+        while True:
+            with self._lock:
+                document = self._docs.get(doc_id)
+                if document is not None:
+                    document.refs += 1
+                    return document
+            if source is None:
+                raise KeyError(f"文档未打开: {doc_id}")
+            self.open(source, doc_id)
+
+    def _release(self, document):
+        with self._lock:
+            document.refs -= 1
+            close = document.closing and document.refs == 0
+        if close:
+            document.close()
+
+    def _retire(self, document):
+        '''关闭已从 _docs 移除的文档，还在渲染时留给最后一个渲染关闭'''
+        with self._lock:
+            document.closing = True
+            close = document.refs == 0
+        if close:
+            document.close()
+
+    def _get_cached(self, key):
+        with self._lock:
+            png = self._pages.get(key)
+            if png is not None:
+                self._pages.move_to_end(key)
+                self.hits += 1
+                return png
+        if self.disk_dir is None:
+            return None
+        name = self._disk_name(key)
+        path = os.path.join(self.disk_dir, name)
+        try:
+            with open(path, 'rb') as f:
+                png = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            if name in self._disk:
+                self._disk.move_to_end(name)
+            self.disk_hits += 1
+            self._put_memory(key, png)
+        return png
+
+    def _put_memory(self, key, png):
+        if key in self._pages:
+            return
+        self._pages[key] = png
+        self._bytes += len(png)
+        while self._bytes > self.max_bytes and len(self._pages) > 1:
+            self._bytes -= len(self._pages.popitem(last=False)[1])
+
+    def _put_disk(self, key, png):
+        if self.disk_dir is None:
+            return
+        name = self._disk_name(key)
+        path = os.path.join(self.disk_dir, name)
+        # 先写临时文件再改名，其他进程不会读到写了一半的文件
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(png)
+        os.replace(tmp, path)
+        victims = []
+        with self._lock:
+            self._disk_bytes += len(png) - self._disk.pop(name, 0)
+            self._disk[name] = len(png)
+            while self._disk_bytes > self.disk_max_bytes and len(self._disk) > 1:
+                victim, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                victims.append(victim)
+        for victim in victims:
+            try:
+                os.remove(os.path.join(self.disk_dir, victim))
+            except FileNotFoundError:
+                pass
+
+    def _render(self, key, source=None):
+        doc_id, page_num, scale = key
+        document = self._acquire(doc_id, source)
+        try:
+            png = document.render(page_num, scale)
+        finally:
+            self._release(document)
+        with self._lock:
+            self.misses += 1
+            self._put_memory(key, png)
+        self._put_disk(key, png)
+        return png
+
+    def get(self, doc_id, page_num, scale=2, source=None):
+        '''
+        返回一页的 PNG 字节，页码从 0 开始，并在后台预取相邻页
+
+        :param source: 文档的 PDF 数据（同 open），文档已被其他会话打开的文档淘汰时用它重新打开
+        '''
+        key = (doc_id, page_num, float(scale))
+        png = self._get_cached(key)
+        if png is None:
+            png = self._render(key, source)
+        self._schedule_prefetch(doc_id, page_num, float(scale))
+        return png
+
+    def _schedule_prefetch(self, doc_id, page_num, scale):
+        if not self.prefetch:
+            return
+        with self._lock:
+            page_count = self._page_counts.get(doc_id, 0)
+        # 先预取后面的页，翻页大多是向后翻
+        for offset in [d for i in range(1, self.prefetch + 1) for d in (i, -i)]:
+            neighbour = page_num + offset
+            key = (doc_id, neighbour, scale)
+            if not 0 <= neighbour < page_count:
+                continue
+            with self._lock:
+                if key in self._pages or key in self._inflight:
+                    continue
+                self._inflight.add(key)
+            self._executor.submit(self._prefetch, key)
+
+    def _prefetch(self, key):
+        try:
+            if self._get_cached(key) is None:
+                self._render(key)
+        except KeyError:
+            # 预取排队期间文档已被淘汰
+            pass
+        finally:
+            with self._lock:
+                self._inflight.discard(key)
+
+    def close(self, doc_id):
+        with self._lock:
+            document = self._docs.pop(doc_id, None)
+            self._page_counts.pop(doc_id, None)
+            for key in [k for k in self._pages if k[0] == doc_id]:
+                self._bytes -= len(self._pages.pop(key))
+        if document is not None:
+            self._retire(document)
+
+    def shutdown(self):
+        '''停止预取线程并关闭全部文档'''
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            doc_ids = list(self._docs)
+        for doc_id in doc_ids:
+            self.close(doc_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "pages": len(self._pages),
+                "bytes": self._bytes,
+                "disk_pages": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+                "documents": len(self._docs),
+            }
+
+
+def get_page_cache():
+    '''进程内共享的渲染缓存'''
+    return get_resource("page_cache", PageCache, close=PageCache.shutdown)
+
+
+if "__main__" == __name__:
+    import sys
+    import tempfile
+    import time
+
+    from utils.timer import Timer
+
+    # 按需渲染 + 预取与逐页直接渲染对比
+    path = sys.argv[1] if len(sys.argv) > 1 else "static/pdfjs/web/compressed.tracemonkey-pldi-09.pdf"
+    with open(path, 'rb') as f:
+        data = f.read()
+    with Timer("直接渲染全部页面"):
+        doc = fitz.open(stream=data, filetype="pdf")
+        for page in doc:
+            page.get_pixmap(matrix=fitz.Matrix(2, 2), alpha=False).tobytes("png")
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = PageCache(disk_dir=tmp)
+        doc_id = cache.open(data)
+        with Timer("首次翻页（按需渲染）"):
+            cache.get(doc_id, 0)
+        waits = []
+        for page_num in range(1, cache.page_count(doc_id)):
+            # 模拟阅读停顿，给预取留出时间
+            time.sleep(0.2)
+            start = time.perf_counter()
+            cache.get(doc_id, page_num)
+            waits.append(time.perf_counter() - start)
+        print(f"顺序翻页平均等待 {sum(waits) / len(waits) * 1000:.2f} ms")
+        print(cache.stats())
+        cache.close(doc_id)
+        reopened = PageCache(disk_dir=tmp, prefetch=0)
+        doc_id = reopened.open(data)
+        with Timer("重启后从磁盘缓存读取第一页"):
+            reopened.get(doc_id, 0)
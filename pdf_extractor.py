@@ -0,0 +1,309 @@
+import io
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
+from pdfminer.converter import PDFPageAggregator
+from pdfminer.layout import LAParams, LTTextContainer
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfparser import PDFParser
+from pdfminer.pdftypes import dict_value, list_value, resolve1
+from pdfminer.psparser import LIT
+
+LITERAL_PAGE = LIT('Page')
+LITERAL_PAGES = LIT('Pages')
+
+
+class Paragraph(NamedTuple):
+    """带页码信息的段落"""
+    text: str
+    page: int    # 段落所在页码（从 0 开始）
+    offset: int  # 段落在该页文本中的起始字符位置
+
+
+def _read_source(source):
+    """把文件路径之外的输入统一读成 bytes，便于传给子进程"""
+    if isinstance(source, (str, os.PathLike)):
+        return os.fspath(source)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    # streamlit 的 UploadedFile 等文件对象
+    if hasattr(source, 'getvalue'):
+        return source.getvalue()
+    source.seek(0)
+    return source.read()
+
+
+class PageSet:
+    """
+    页码集合，页码从 0 开始，负数表示倒数第几页
+
+    支持单页、range、slice 以及它们任意组合的可迭代对象，None 表示全部页。
+    内部用位图保存，成员判断为 O(1)，超出页数范围的页码会被忽略。
+    """
+    def __init__(self, num_pages, pages=None):
+        self.num_pages = num_pages
+        self._bits = bytearray(num_pages)
+        self.add(slice(None) if pages is None else pages)
+
+    def add(self, pages):
+        """把页码、range、slice 或它们的组合加入集合"""
+        n = self.num_pages
+        if isinstance(pages, PageSet):
+            pages = pages.runs()
+        if isinstance(pages, slice):
+            pages = range(*pages.indices(n))
+        if isinstance(pages, range):
+            if pages.step == 1:
+                start, stop = max(pages.start, 0), min(pages.stop, n)
+                if start < stop:
+                    self._bits[start:stop] = b'\x01' * (stop - start)
+            else:
+                for i in pages:
+                    self._add_one(i)
+        elif isinstance(pages, int):
+            self._add_one(pages if pages >= 0 else pages + n)
+        else:
+            for item in pages:
+                self.add(item)
+        return self
+
+    def _add_one(self, i):
+        if 0 <= i < self.num_pages:
+            self._bits[i] = 1
+
+    def __contains__(self, i):
+        return 0 <= i < self.num_pages and self._bits[i] == 1
+
+    def __len__(self):
+        return self._bits.count(1)
+
+    def __bool__(self):
+        return self.first >= 0
+
+    def __iter__(self):
+        i = self._bits.find(1)
+        while i >= 0:
+            yield i
+            i = self._bits.find(1, i + 1)
+
+    def __repr__(self):
+        runs = ', '.join(f'{r.start}-{r.stop - 1}' if len(r) > 1 else str(r.start) for r in self.runs())
+        return f'PageSet({self.num_pages}, [{runs}])'
+
+    @property
+    def first(self):
+        """第一个选中的页码，没有选中任何页时为 -1"""
+        return self._bits.find(1)
+
+    @property
+    def last(self):
+        """最后一个选中的页码，没有选中任何页时为 -1"""
+        return self._bits.rfind(1)
+
+    def intersects(self, start, stop):
+        """[start, stop) 区间内是否有选中的页"""
+        return self._bits.find(1, max(start, 0), stop) >= 0
+
+    def runs(self):
+        """把选中的页合并成连续区间，返回 range 列表"""
+        runs = []
+        i = self._bits.find(1)
+        while i >= 0:
+            j = self._bits.find(0, i)
+            if j < 0:
+                j = self.num_pages
+            runs.append(range(i, j))
+            i = self._bits.find(1, j)
+        return runs
+
+    def difference(self, other):
+        """返回在本集合中但不在 other 中的页"""
+        result = PageSet(self.num_pages, ())
+        result._bits[:] = self._bits
+        for i in other:
+            if 0 <= i < self.num_pages:
+                result._bits[i] = 0
+        return result
+
+
+def _open_source(source):
+    if isinstance(source, str):
+        return open(source, 'rb')
+    return io.BytesIO(source)
+
+
+def _num_pages(doc):
+    try:
+        return int(resolve1(dict_value(doc.catalog['Pages'])['Count']))
+    except (KeyError, TypeError, ValueError):
+        return sum(1 for _ in PDFPage.create_pages(doc))
+
+
+def count_pages(source):
+    """读取 PDF 页数（只读页树根节点，不做版面分析）"""
+    with _open_source(_read_source(source)) as fp:
+        return _num_pages(PDFDocument(PDFParser(fp)))
+
+
+def _iter_selected_pages(doc, pages):
+    """
+    按页树的 Count 直接跳过不含选中页的子树，只为选中的页创建 PDFPage
+
+    页树结构异常时退回到 PDFPage.create_pages 逐页遍历
+    """
+    def walk(obj, parent, base):
+        objid = getattr(obj, 'objid', None)
+        node = dict_value(obj).copy()
+        for k, v in parent.items():
+            if k in PDFPage.INHERITABLE_ATTRS and k not in node:
+                node[k] = v
+        node_type = node.get('Type') or node.get('type')
+        if node_type is LITERAL_PAGES and 'Kids' in node:
+            for kid in list_value(node['Kids']):
+                if base > pages.last:
+                    return
+                kid_node = dict_value(kid)
+                kid_type = kid_node.get('Type') or kid_node.get('type')
+                count = resolve1(kid_node.get('Count', 1)) if kid_type is LITERAL_PAGES else 1
+                if pages.intersects(base, base + count):
+                    yield from walk(kid, node, base)
+                base += count
+        elif node_type is LITERAL_PAGE and base in pages:
+            yield base, PDFPage(doc, objid, node, None)
+
+    done = -1
+    try:
+        for i, page in walk(doc.catalog['Pages'], doc.catalog, 0):
+            done = i
+            yield i, page
+    except (KeyError, TypeError, ValueError):
+        for i, page in enumerate(PDFPage.create_pages(doc)):
+            if i > pages.last:
+                break
+            if i > done and i in pages:
+                yield i, page
+
+
+def _iter_page_layouts(fp, page_numbers=None):
+    """逐页做版面分析，未选中的页直接跳过，既不创建也不解释其内容流"""
+    doc = PDFDocument(PDFParser(fp))
+    pages = page_numbers if isinstance(page_numbers, PageSet) else PageSet(_num_pages(doc), page_numbers)
+    rsrcmgr = PDFResourceManager(caching=True)
+    device = PDFPageAggregator(rsrcmgr, laparams=LAParams())
+    interpreter = PDFPageInterpreter(rsrcmgr, device)
+    for i, page in _iter_selected_pages(doc, pages):
+        interpreter.process_page(page)
+        yield i, device.get_result()
+
+
+def _page_paragraphs(page_no, page_layout, min_line_length):
+    """按空行把一页文本重新组织成段落，与原 extract_text_from_pdf 的拼接规则一致"""
+    buffer = []
+    start = pos = 0
+    tail = ''
+    for element in page_layout:
+        if not isinstance(element, LTTextContainer):
+            continue
+        # 与原实现一样，每个文本块后追加一个换行
+        lines = (tail + element.get_text() + '\n').split('\n')
+        tail = lines.pop()
+        for text in lines:
+            if len(text) >= min_line_length:
+                if not buffer:
+                    start = pos
+                buffer.append((' '+text) if not text.endswith('-') else text.strip('-'))
+            elif buffer:
+                yield Paragraph(''.join(buffer), page_no, start)
+                buffer = []
+            pos += len(text) + 1
+    if tail and len(tail) >= min_line_length:
+        if not buffer:
+            start = pos
+        buffer.append((' '+tail) if not tail.endswith('-') else tail.strip('-'))
+    if buffer:
+        yield Paragraph(''.join(buffer), page_no, start)
+
+
+def _iter_source_paragraphs(source, pages, min_line_length):
+    with _open_source(source) as fp:
+        for page_no, page_layout in _iter_page_layouts(fp, pages):
+            yield from _page_paragraphs(page_no, page_layout, min_line_length)
+
+
+# 子进程中共享的 PDF 数据，由 _init_worker 设置，避免每个任务都重复传输整份文件
+_worker_source = None
+
+
+def _init_worker(source):
+    global _worker_source
+    _worker_source = source
+
+
+def _extract_pages(pages, min_line_length):
+    return list(_iter_source_paragraphs(_worker_source, pages, min_line_length))
+
+
+def _split_tasks(pages, pages_per_task):
+    """把选中的页按页序切成若干任务，每个任务最多 pages_per_task 页"""
+    tasks = []
+    for run in pages.runs():
+        for start in range(run.start, run.stop, pages_per_task):
+            tasks.append(range(start, min(start + pages_per_task, run.stop)))
+    return tasks
+
+
+def iter_paragraphs(source, page_numbers=None, min_line_length=1, workers=1, pages_per_task=16, mp_context=None):
+    """
+    流式地从 PDF 中（按指定页码）提取段落，逐个 yield 带页码的 Paragraph
+
+    :param source: PDF 文件路径、bytes 或文件对象
+    :param page_numbers: 需要提取的页码（从 0 开始），可以是 PageSet、页码、range、slice
+                         或它们的组合，None 表示全部页
+    :param min_line_length: 长度小于该值的行视为段落分隔
+    :param workers: 进程数，默认 1 即在当前进程中提取；None 表示使用 CPU 核数。
+                    在 streamlit 等多线程进程中 fork 进程池不安全，只有批量入库的调用方才应开启
+    :param pages_per_task: 每个子进程任务处理的页数
+    :param mp_context: 进程池的 multiprocessing 上下文，如在多线程进程中使用 spawn
+    """
+    source = _read_source(source)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    tasks = []
+    if workers > 1:
+        pages = page_numbers
+        if not isinstance(pages, PageSet):
+            pages = PageSet(count_pages(source), page_numbers)
+        tasks = _split_tasks(pages, pages_per_task)
+    if len(tasks) <= 1:
+        yield from _iter_source_paragraphs(source, page_numbers, min_line_length)
+        return
+
+    pool = ProcessPoolExecutor(
+        max_workers=min(workers, len(tasks)), mp_context=mp_context, initializer=_init_worker, initargs=(source,))
+    pending = deque()
+    try:
+        for task in tasks:
+            pending.append(pool.submit(_extract_pages, task, min_line_length))
+            # 限制在途任务数量，按页序输出结果
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+if "__main__" == __name__:
+    import sys
+    from utils.timer import Timer
+
+    with Timer("提取段落"):
+        paragraphs = list(iter_paragraphs(sys.argv[1], min_line_length=10, workers=None))
+    print(f"共 {len(paragraphs)} 个段落")
+    for p in paragraphs[:5]:
+        print(p.page, p.offset, p.text[:80])
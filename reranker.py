@@ -0,0 +1,160 @@
+"""
+基于 CrossEncoder 的检索结果重排
+
+用法：
+    RERANK_MODEL=BAAI/bge-reranker-base streamlit run main.py
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from answer_cache import normalize_query
+from conf import rerank_latency_budget, rerank_model, rerank_workers
+from resources import get_resource, resource_key
+
+
+class Reranker:
+    """
+    在 CPU 上用 CrossEncoder 给 (问题, 片段) 打分并重排
+
+    得分按 (归一化问题, 片段哈希) 做 LRU 缓存；未缓存的片段按长度排序后分批在打分线程池中计算，
+    最多等待到时间预算用完。超出预算时已算出得分的片段在它们原来占的位置之间按得分重排，
+    其余片段保持向量检索的顺序。超时时正在计算的批次仍会完成并写入缓存，尚未开始的批次取消。
+    """
+    def __init__(self, model_name, batch_size=16, max_length=512, cache_size=20000,
+                 latency_budget=rerank_latency_budget, num_threads=None, workers=rerank_workers):
+        """
+        :param model_name: CrossEncoder 模型名或本地路径，如 BAAI/bge-reranker-base
+        :param batch_size: 每批打分的片段数
+        :param max_length: (问题, 片段) 拼接后的最大 token 数
+        :param cache_size: 缓存的得分条数上限
+        :param latency_budget: 每次重排的时间预算（秒），None 表示不限
+        :param num_threads: torch 推理使用的线程数，None 表示保持默认
+        :param workers: 打分线程数，所有会话共用
+        """
+        import torch
+        from sentence_transformers import CrossEncoder
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.model = CrossEncoder(model_name, max_length=max_length, device='cpu')
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.latency_budget = latency_budget
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+        # 推理放在线程池中，等待可以按截止时间中断；几个线程即可，一个会话的慢请求不会让其他会话全部超时
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rerank")
+
+    @staticmethod
+    def _key(query, document):
+        return normalize_query(query), hashlib.sha1(document.encode('utf-8')).digest()
+
+    def score(self, query, documents, deadline=None):
+        '''
+        返回每个片段的相关性得分，越大越相关
+
+        :param deadline: time.perf_counter() 的截止时间，最多等待到该时间，届时未打分的片段得分为 None
+        '''
+        keys = [self._key(query, doc) for doc in documents]
+        scores = [None] * len(documents)
+        with self._lock:
+            for i, key in enumerate(keys):
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    scores[i] = self._cache[key]
+            missing = sorted((i for i, s in enumerate(scores) if s is None), key=lambda i: len(documents[i]))
+            self.hits += len(documents) - len(missing)
+            self.misses += len(missing)
+        futures = [self._executor.submit(self._predict, query, documents, keys, scores,
+                                         missing[start:start + self.batch_size])
+                   for start in range(0, len(missing), self.batch_size)]
+        timeout = None if deadline is None else max(0.0, deadline - time.perf_counter())
+        done, not_done = wait(futures, timeout=timeout)
+        for future in not_done:
+            future.cancel()
+        for future in done:
+            future.result()
+        with self._lock:
+            # 返回副本，超时后仍在计算的一批不会改动调用方拿到的结果
+            return list(scores)
+
+    def _predict(self, query, documents, keys, scores, batch):
+        predicted = self.model.predict([(query, documents[i]) for i in batch],
+                                       batch_size=len(batch), show_progress_bar=False)
+        with self._lock:
+            for i, value in zip(batch, predicted):
+                scores[i] = float(value)
+                self._cache[keys[i]] = scores[i]
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def rerank(self, query, results, top_n, latency_budget=None):
+        '''
+        重排与 chroma 相同格式的检索结果，返回前 top_n 个，格式不变
+
+        :param latency_budget: 本次重排的时间预算（秒），None 时使用初始化时的设置
+        '''
+        budget = self.latency_budget if latency_budget is None else latency_budget
+        deadline = time.perf_counter() + budget if budget is not None else None
+        documents = results['documents'][0]
+        scores = self.score(query, documents, deadline)
+        scored = [i for i, s in enumerate(scores) if s is not None]
+        if len(scored) < len(scores):
+            # 超出时间预算：已打分的片段在它们占的位置之间按得分重排，未打分的片段留在原位
+            self.fallbacks += 1
+            order = list(range(len(documents)))
+            for slot, i in zip(scored, sorted(scored, key=lambda i: -scores[i])):
+                order[slot] = i
+            order = order[:top_n]
+        else:
+            order = sorted(range(len(documents)), key=lambda i: -scores[i])[:top_n]
+        return {key: [[results[key][0][i] for i in order]]
+                for key in ('ids', 'documents', 'metadatas', 'distances') if results.get(key)}
+
+    def stats(self):
+        '''得分缓存命中与回退统计'''
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "fallbacks": self.fallbacks,
+            "entries": len(self._cache),
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def get_reranker(model_name=rerank_model, **kwargs):
+    '''返回进程内共享的 Reranker（同一模型和参数只加载一次），未配置模型时返回 None'''
+    if not model_name:
+        return None
+    return get_resource(resource_key("reranker", model_name, **kwargs), lambda: Reranker(model_name, **kwargs),
+                        close=Reranker.close)
+
+
+if "__main__" == __name__:
+    import sys
+
+    from utils.timer import Timer
+
+    # 冷启动、缓存命中以及时间预算不足时的重排耗时
+    reranker = Reranker(sys.argv[1] if len(sys.argv) > 1 else "BAAI/bge-reranker-base")
+    documents = [f"第 {i} 段：检索增强生成先检索相关片段，再把片段放进提示词交给大模型回答。" * (1 + i % 4)
+                 for i in range(16)]
+    results = {'ids': [[str(i) for i in range(16)]], 'documents': [documents],
+               'metadatas': [[{}] * 16], 'distances': [[i / 16 for i in range(16)]]}
+    with Timer("重排 16 个候选（未缓存）"):
+        first = reranker.rerank("什么是检索增强生成", results, 2, latency_budget=60)
+    with Timer("重排 16 个候选（缓存命中）"):
+        second = reranker.rerank("什么是检索增强生成？", results, 2, latency_budget=60)
+    with Timer("时间预算为 0 的新问题"):
+        fallback = reranker.rerank("大模型如何回答", results, 2, latency_budget=0)
+    print(first['ids'], second['ids'], fallback['ids'], reranker.stats())
@@ -0,0 +1,243 @@
+"""
+进程内共享的资源（模型、客户端、缓存、索引），所有 streamlit 会话共用一份
+
+资源在第一次使用时创建，每个资源有自己的锁，加载慢的模型不会挡住其他资源。
+进程退出时按创建的逆序释放，footprint() 报告每个资源的内存占用，每个资源创建时记一条日志。
+不用 st.cache_resource：index_cli、基准脚本等不在 streamlit 中运行的代码也共用这些资源，
+而且 cache_resource 不提供按依赖顺序的关闭和内存统计。
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _rss():
+    '''当前进程的常驻内存（字节），无法读取时返回 None'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+def _module_bytes(module):
+    '''torch 模型的参数和缓冲区大小'''
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def estimate_bytes(obj):
+    '''
+    估算资源自身持有的内存，无法估算时返回 None
+
+    依次尝试 memory_usage()、stats() 中的 bytes、numpy 数组的 nbytes、torch 模型（或 .model 属性）的参数大小
+    '''
+    if hasattr(obj, 'memory_usage'):
+        return obj.memory_usage()
+    if hasattr(obj, 'stats'):
+        stats = obj.stats()
+        if isinstance(stats, dict) and 'bytes' in stats:
+            return stats['bytes']
+    if hasattr(obj, 'nbytes'):
+        return int(obj.nbytes)
+    for module in (obj, getattr(obj, 'model', None)):
+        if hasattr(module, 'parameters') and hasattr(module, 'buffers'):
+            return _module_bytes(module)
+    return None
+
+
+class _Resource:
+    def __init__(self, name, factory, close=None):
+        self.name = name
+        self.factory = factory
+        self.close = close
+        self.instance = None
+        self.lock = threading.Lock()
+        self.load_seconds = None
+        self.rss_delta = None
+        self.created = None
+
+
+class ResourceManager:
+    """按名称管理共享资源的创建、替换和释放"""
+    def __init__(self):
+        self._resources = {}
+        self._order = []
+        self._lock = threading.Lock()
+
+    def register(self, name, factory, close=None):
+        '''
+        登记资源，同名资源已登记时保持原样，因此创建参数不同的资源要用不同的名称（见 resource_key）
+
+        :param factory: 创建资源的无参函数
+        :param close: 释放资源的函数，参数为资源实例
+        '''
+        with self._lock:
+            resource = self._resources.get(name)
+            if resource is None:
+                resource = self._resources[name] = _Resource(name, factory, close)
+            return resource
+
+    def get(self, name, factory=None, close=None):
+        '''取得资源，第一次使用时创建；提供 factory 时顺带登记'''
+        if factory is not None:
+            resource = self.register(name, factory, close)
+        else:
+            with self._lock:
+                resource = self._resources.get(name)
+            if resource is None:
+                raise KeyError(f"未登记的资源: {name}")
+        instance = resource.instance
+        if instance is not None:
+            return instance
+        with resource.lock:
+            if resource.instance is None:
+                rss = _rss()
+                start = time.perf_counter()
+                instance = resource.factory()
+                resource.load_seconds = time.perf_counter() - start
+                after = _rss()
+                resource.rss_delta = after - rss if rss is not None and after is not None else None
+                resource.created = time.time()
+                resource.instance = instance
+                with self._lock:
+                    self._order.append(name)
+                logger.info("加载资源 %s (%s)：%.2f s，常驻内存增量 %s", name, type(instance).__name__,
+                            resource.load_seconds, "-" if resource.rss_delta is None
+                            else f"{resource.rss_delta / 1024 / 1024:.1f} MB")
+            return resource.instance
+
+    def set(self, name, instance, close=None):
+        '''直接指定资源实例（如测试或基准中替换为临时目录的缓存），原有实例会被释放'''
+        self.release(name)
+        resource = self.register(name, lambda: instance, close)
+        with resource.lock:
+            resource.factory = lambda: instance
+            resource.close = close
+            resource.instance = instance
+            resource.created = time.time()
+        with self._lock:
+            self._order.append(name)
+        return instance
+
+    def release(self, name):
+        '''释放一个资源，下次使用时重新创建'''
+        with self._lock:
+            resource = self._resources.get(name)
+            if name in self._order:
+                self._order.remove(name)
+        if resource is None:
+            return
+        with resource.lock:
+            instance, resource.instance = resource.instance, None
+            if instance is not None and resource.close is not None:
+                resource.close(instance)
+
+    def shutdown(self):
+        '''按创建的逆序释放全部资源'''
+        with self._lock:
+            names = list(reversed(self._order))
+        for name in names:
+            try:
+                self.release(name)
+            except Exception:
+                # 退出时尽量释放其余资源
+                pass
+
+    def footprint(self):
+        '''每个已创建资源的内存占用：自身估算的字节数、创建前后常驻内存的增量和加载耗时'''
+        with self._lock:
+            resources = [self._resources[name] for name in self._order]
+        report = []
+        for resource in resources:
+            instance = resource.instance
+            if instance is None:
+                continue
+            try:
+                size = estimate_bytes(instance)
+            except Exception:
+                size = None
+            report.append({
+                "name": resource.name,
+                "type": type(instance).__name__,
+                "bytes": size,
+                "rss_delta": resource.rss_delta,
+                "load_seconds": resource.load_seconds,
+            })
+        return report
+
+
+manager = ResourceManager()
+atexit.register(manager.shutdown)
+
+
+def resource_key(kind, *args, **kwargs):
+    '''由资源类别和创建参数组成资源名，如 "reranker:BAAI/bge-reranker-base,batch_size=8"'''
+    params = [str(a) for a in args] + [f"{k}={v!r}" for k, v in sorted(kwargs.items())]
+    return f"{kind}:{','.join(params)}"
+
+
+def get_resource(name, factory=None, close=None):
+    return manager.get(name, factory, close)
+
+
+def set_resource(name, instance, close=None):
+    return manager.set(name, instance, close)
+
+
+def release_resource(name):
+    manager.release(name)
+
+
+def footprint():
+    return manager.footprint()
+
+
+def format_footprint(report=None):
+    '''把 footprint() 的结果整理成便于阅读的表格文本'''
+    def mb(value):
+        return "-" if value is None else f"{value / 1024 / 1024:.1f} MB"
+    lines = [f"{'资源':<40}{'类型':<24}{'自身':>12}{'常驻内存增量':>14}{'加载耗时':>10}"]
+    for row in report if report is not None else footprint():
+        seconds = "-" if row['load_seconds'] is None else f"{row['load_seconds']:.2f} s"
+        lines.append(f"{row['name']:<40}{row['type']:<24}{mb(row['bytes']):>12}"
+                     f"{mb(row['rss_delta']):>14}{seconds:>10}")
+    return '\n'.join(lines)
+
+
+if "__main__" == __name__:
+    import sys
+    from concurrent.futures import ThreadPoolExecutor
+
+    # 模拟 50 个会话同时取用资源，常驻内存应与会话数无关
+    import resources  # 其他模块登记在导入的 resources 中，而不是 __main__
+    from local_embedding import get_local_embedder
+    from mybase import get_answer_cache, get_client
+
+    model = sys.argv[1] if len(sys.argv) > 1 else "BAAI/bge-small-zh-v1.5"
+    os.environ.setdefault("OPENAI_API_KEY", "placeholder")
+
+    def session(i):
+        get_client()
+        get_answer_cache()
+        get_local_embedder(model).embed([f"第 {i} 个会话的问题"])
+
+    before = _rss()
+    with ThreadPoolExecutor(max_workers=50) as pool:
+        list(pool.map(session, range(50)))
+    after_50 = _rss()
+    with ThreadPoolExecutor(max_workers=50) as pool:
+        list(pool.map(session, range(50, 100)))
+    after_100 = _rss()
+    print(resources.format_footprint())
+    print(f"前 50 个会话常驻内存增加 {(after_50 - before) / 1024 / 1024:.1f} MB，"
+          f"再 50 个会话增加 {(after_100 - after_50) / 1024 / 1024:.1f} MB")
@@ -0,0 +1,35 @@
+import hashlib
+import os
+
+
+def file_fingerprint(source, chunk_size=1024 * 1024):
+    """
+    流式计算文件内容的 SHA-256，作为文档指纹
+
+    :param source: 文件路径、bytes/memoryview 或文件对象（如 streamlit 的 UploadedFile）
+    """
+    h = hashlib.sha256()
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            for block in iter(lambda: f.read(chunk_size), b''):
+                h.update(block)
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        for i in range(0, len(view), chunk_size):
+            h.update(view[i:i + chunk_size])
+    elif hasattr(source, 'getbuffer'):
+        # BytesIO 及其子类可以直接拿到内部缓冲区，不用复制
+        with source.getbuffer() as view:
+            return file_fingerprint(view, chunk_size)
+    else:
+        pos = source.tell()
+        source.seek(0)
+        for block in iter(lambda: source.read(chunk_size), b''):
+            h.update(block)
+        source.seek(pos)
+    return h.hexdigest()
+
+
+def chunk_fingerprint(doc_id, text):
+    """文档内片段的内容哈希，用作向量库中的 id"""
+    return hashlib.sha256(f"{doc_id}\0{text}".encode('utf-8')).hexdigest()[:32]
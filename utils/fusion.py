@@ -0,0 +1,27 @@
+def reciprocal_rank_fusion(results_list, top_n=None, k=60, weights=None):
+    '''
+    用倒数排名融合 (RRF) 合并多路检索结果，同一片段只保留一次
+
+    :param results_list: 若干个与 chroma 相同格式的检索结果
+    :param top_n: 最多返回的片段数，None 表示全部返回
+    :param k: RRF 平滑常数，得分为 sum(权重 / (k + 名次))
+    :param weights: 每路结果的权重，None 表示各路相同
+    :return: 与 chroma 相同格式的结果，distances 为 1 - 融合得分
+    '''
+    scores = {}
+    items = {}
+    weights = weights or [1.0] * len(results_list)
+    for results, weight in zip(results_list, weights):
+        ids = results['ids'][0]
+        documents = results['documents'][0]
+        metadatas = (results.get('metadatas') or [None])[0] or [None] * len(ids)
+        for rank, (chunk_id, doc, meta) in enumerate(zip(ids, documents, metadatas)):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + weight / (k + rank + 1)
+            items.setdefault(chunk_id, (doc, meta))
+    ranked = sorted(scores, key=lambda chunk_id: -scores[chunk_id])[:top_n]
+    return {
+        'ids': [ranked],
+        'documents': [[items[i][0] for i in ranked]],
+        'metadatas': [[items[i][1] for i in ranked]],
+        'distances': [[1 - scores[i] for i in ranked]],
+    }
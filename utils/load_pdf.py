@@ -3,8 +3,12 @@ import os  # 导入os库，用于文件操作
 import io  # 导入io库，用于处理二进制数据流
 import base64  # 导入base64库，用于PDF文件的编码
 from PIL import Image  # 导入PIL库中的Image模块，用于图像处理
+import threading  # 导入threading库，用于保护预览缓存
+from collections import OrderedDict
 from PyPDF2 import PdfReader, PdfWriter
-from conf import container_height
+from conf import container_height, preview_cache_max_bytes, preview_max_documents
+from resources import get_resource
+from utils.fingerprint import file_fingerprint
 
 def show_pdf(file_data):
     """
@@ -33,31 +37,143 @@ def show_pdf(file_data):
         # 如果发生错误，显示错误信息
         st.error(f"发生错误: {str(e)}")
 
-def show_original_pdf(file_data, file_size):
+class _MemoryReader(io.RawIOBase):
+    """只读的内存流，直接从 memoryview 读取，不复制整个文件"""
+    def __init__(self, view):
+        self._view = memoryview(view).cast('B')
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), len(self._view) - self._pos)
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._view)}[whence]
+        self._pos = max(base + offset, 0)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+class PdfPreview:
+    """一个上传文件的预览：只解析一次，单页 PDF 按页缓存"""
+    def __init__(self, doc_id, data):
+        self.doc_id = doc_id
+        # 上传文件的缓冲区在每次重跑时都会换新，这里保留一份自己的数据
+        self.data = bytes(data)
+        self.lock = threading.Lock()
+        self.reader = PdfReader(_MemoryReader(self.data))
+        self.num_pages = len(self.reader.pages)
+
+    def render_page(self, page_index):
+        '''把一页写成单页 PDF，返回 base64 编码的字符串'''
+        with self.lock:
+            pdf_writer = PdfWriter()
+            pdf_writer.add_page(self.reader.pages[page_index])
+            output_bytes = io.BytesIO()
+            pdf_writer.write(output_bytes)
+        with output_bytes.getbuffer() as view:
+            return base64.b64encode(view).decode('utf-8')
+
+
+class PreviewService:
+    """
+    PDF 预览服务，每个上传文件（按内容指纹）只解析一次
+
+    单页 PDF 的 base64 结果按 (文档指纹, 页码) 缓存，超出容量上限时按最近访问淘汰，翻页时不再重新解析和编码。
+    """
+    def __init__(self, max_bytes=preview_cache_max_bytes, max_documents=preview_max_documents):
+        self.max_bytes = max_bytes
+        self.max_documents = max_documents
+        self._docs = OrderedDict()
+        self._pages = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def open(self, file_data, doc_id=None):
+        '''
+        返回上传文件对应的 PdfPreview
+
+        :param file_data: bytes 或 memoryview
+        :param doc_id: 文档登记表中的文档指纹，None 表示现算
+        '''
+        doc_id = doc_id or file_fingerprint(file_data)
+        with self._lock:
+            preview = self._docs.get(doc_id)
+            if preview is not None:
+                self._docs.move_to_end(doc_id)
+                return preview
+        preview = PdfPreview(doc_id, file_data)
+        with self._lock:
+            preview = self._docs.setdefault(doc_id, preview)
+            self._docs.move_to_end(doc_id)
+            while len(self._docs) > self.max_documents:
+                old_id, _ = self._docs.popitem(last=False)
+                for key in [k for k in self._pages if k[0] == old_id]:
+                    self._bytes -= len(self._pages.pop(key))
+        return preview
+
+    def page(self, preview, page_index):
+        '''一页的单页 PDF（base64），命中缓存时直接返回'''
+        key = (preview.doc_id, page_index)
+        with self._lock:
+            encoded = self._pages.get(key)
+            if encoded is not None:
+                self._pages.move_to_end(key)
+                return encoded
+        encoded = preview.render_page(page_index)
+        with self._lock:
+            if key not in self._pages:
+                self._pages[key] = encoded
+                self._bytes += len(encoded)
+                while self._bytes > self.max_bytes and len(self._pages) > 1:
+                    self._bytes -= len(self._pages.popitem(last=False)[1])
+        return encoded
+
+    def memory_usage(self):
+        '''缓存的单页 PDF 与打开的文件数据占用的字节数'''
+        with self._lock:
+            return self._bytes + sum(len(p.data) for p in self._docs.values())
+
+
+def get_preview_service():
+    '''进程内共享的预览服务，与其他缓存一样由资源层管理'''
+    return get_resource("preview_service", PreviewService)
+
+
+def show_original_pdf(file_data, file_size, doc_id=None):
+    """
+    显示上传 PDF 的一页及翻页控件
+
+    :param file_data: PDF 数据，bytes 或 memoryview（如 UploadedFile.getbuffer()）
+    :param file_size: 文件大小（MB）
+    :param doc_id: 文档登记表中的文档指纹
+    """
     try:
         # st.write("PDF 预览：")
-        # 创建PDF阅读器
-        pdf_reader = PdfReader(io.BytesIO(file_data))
+        service = get_preview_service()
+        preview = service.open(file_data, doc_id)
         # 获取PDF的页数
-        num_pages = len(pdf_reader.pages)
+        num_pages = preview.num_pages
         st.session_state.num_pages = num_pages
 
-         # 使用 session_state 来保存当前页码
+        # 使用 session_state 来保存当前页码
         if 'current_page' not in st.session_state:
             st.session_state.current_page = 1
+        # 换了更短的文件时页码不能越界
+        st.session_state.current_page = min(st.session_state.current_page, num_pages)
 
-        # 创建一个新的 PDF 写入器，只包含选中的页面
-        pdf_writer = PdfWriter()
-        current_pages = st.session_state.current_page - 1
-        pdf_writer.add_page(pdf_reader.pages[current_pages])
-
-        # 将单页 PDF 转换为字节流
-        output_bytes = io.BytesIO()
-        pdf_writer.write(output_bytes)
-        pdf_bytes = output_bytes.getvalue()
-
-        # 将PDF字节数据转换为base64编码
-        base64_pdf = base64.b64encode(pdf_bytes).decode('utf-8')
+        # 取当前页的单页 PDF，翻到看过的页时直接用缓存
+        base64_pdf = service.page(preview, st.session_state.current_page - 1)
 
         # 创建HTML嵌入标签来显示PDF
         pdf_display = f'<iframe src="data:application/pdf;base64,{base64_pdf}" \
@@ -0,0 +1,29 @@
+import re
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 中日韩文字及全角标点，粗略按每个字 1 个 token 估算
+_CJK_PATTERN = re.compile('[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+_encodings = {}
+
+
+def _get_encoding(model):
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding("cl100k_base")
+    return _encodings[model]
+
+
+def count_tokens(text, model="text-embedding-ada-002"):
+    '''计算文本的 token 数，安装了 tiktoken 时精确计算，否则按字符估算'''
+    if tiktoken is not None:
+        return len(_get_encoding(model).encode(text, disallowed_special=()))
+    cjk = len(_CJK_PATTERN.findall(text))
+    # 其余字符约 4 个一个 token
+    return cjk + (len(text) - cjk + 3) // 4